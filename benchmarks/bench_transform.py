@@ -0,0 +1,359 @@
+""" Benchmark of the transform.
+
+Times the functions the transform spends its time in on synthetic financial
+statements, one call at a time, and then runs the transform end to end
+against a temporary SQLite database filled with a synthetic corpus, reporting
+financial statements/sec.
+
+With --output the result is appended as a JSON line, and with --baseline it
+is compared with the last result in such a file; the exit code is 1 if any
+benchmark got slower by more than --threshold.
+
+Usage:
+
+    python -m benchmarks.bench_transform --statements 2000 -o results.jsonl
+    python -m benchmarks.bench_transform --baseline results.jsonl
+"""
+import argparse
+import datetime
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+from types import SimpleNamespace
+
+from regnskaber import setup_database_connection
+from regnskaber import fetch
+from regnskaber import make_feature_table
+from regnskaber.regnskab_inserter import insert_parsed, parse_regnskab
+from regnskaber.shared import (EntryRow, entry_in_reporting_period,
+                               filter_reporting_period, parse_decimals,
+                               parse_numeric_value)
+
+from .corpus import make_corpus, resources, table_concepts
+
+TABLE_DEFINITION_FILES = ('feature_table_regnskabstal.json',
+                          'feature_table_regnskabstekst.json')
+
+DIMENSIONS = ('0', 'cmn:ConsolidatedMember', 'fsa:ExtraordinaryItemsMember',
+              'cmn:EmployeesMember')
+
+WORDS = ('Selskabet', 'har', 'i', 'året', 'haft', 'et', 'overskud', 'på')
+
+
+def make_statement(fs_id, entries, dimensions_share=0.05,
+                   consolidated_share=0.1, rng=random):
+    """Returns the EntryRows of a synthetic financial statement with about
+    entries entries, as read by shared.financial_statement_iterator before
+    filtering the reporting period.
+
+    A share of dimensions_share of the entries have dimensions, and a share
+    of consolidated_share are reported for the group.  About half of the
+    entries are of the previous year, so outside the reporting period.
+
+    """
+    year = rng.randint(2012, 2017)
+    start_date = datetime.datetime(year, 1, 1)
+    end_date = datetime.datetime(year, 12, 31)
+    previous_start = datetime.datetime(year - 1, 1, 1)
+    previous_end = datetime.datetime(year - 1, 12, 31)
+    cvrnummer = 10000000 + rng.randint(0, 10**6)
+    numbers = table_concepts('feature_table_regnskabstal.json')
+    texts = table_concepts('feature_table_regnskabstekst.json')
+    instant_concepts = set(numbers[::3])
+
+    values = [
+        ('gsd:ReportingPeriodStartDate', start_date.strftime('%Y-%m-%d'),
+         None, start_date, end_date, None, None, False),
+        ('gsd:ReportingPeriodEndDate', end_date.strftime('%Y-%m-%d'),
+         None, start_date, end_date, None, None, False),
+        ('gsd:IdentificationNumberCvrOfReportingEntity', str(cvrnummer),
+         None, start_date, end_date, None, None, False),
+    ]
+    for i in range(max(entries - len(values), 0)):
+        dimensions = None
+        if rng.random() < dimensions_share:
+            dimensions = rng.choice(DIMENSIONS)
+        koncern = rng.random() < consolidated_share
+        if rng.random() < 0.8:
+            concept = rng.choice(numbers)
+            current = rng.random() < 0.5
+            if concept in instant_concepts:
+                period = (None, end_date if current else previous_end)
+            elif current:
+                period = (start_date, end_date)
+            else:
+                period = (previous_start, previous_end)
+            decimals = rng.choice(['0', '-3', '-6', 'INF'])
+            values.append((concept, str(rng.randint(-10**7, 10**8)),
+                           decimals) + period +
+                          (dimensions, 'iso4217:DKK', koncern))
+        else:
+            text = ' '.join(rng.choice(WORDS)
+                            for _ in range(rng.randint(5, 200)))
+            values.append((rng.choice(texts), text, None, start_date,
+                           end_date, dimensions, None, koncern))
+
+    statement = []
+    for i, (fieldName, fieldValue, decimals, entry_start_date,
+            entry_end_date, dimensions, unit, koncern) in enumerate(values):
+        statement.append(EntryRow(
+            id=fs_id * 100000 + i,
+            financial_statement_id=fs_id,
+            fieldName=fieldName,
+            fieldValue=fieldValue,
+            decimals=decimals,
+            cvrnummer=cvrnummer,
+            startDate=entry_start_date,
+            endDate=entry_end_date,
+            dimensions=dimensions,
+            unitIdXbrl=unit,
+            koncern=koncern,
+            numericValue=parse_numeric_value(fieldValue, decimals),
+            decimalsValue=parse_decimals(decimals),
+            inReportingPeriod=entry_in_reporting_period(
+                start_date, end_date, entry_start_date, entry_end_date
+            ),
+        ))
+    return statement
+
+
+def load_table_descriptions():
+    table_descriptions = []
+    for filename in TABLE_DEFINITION_FILES:
+        with open(str(resources / filename)) as fp:
+            table_descriptions.extend(json.load(fp))
+    return table_descriptions
+
+
+def call_summary(seconds):
+    """Returns count, total seconds, mean and percentiles in microseconds."""
+    ordered = sorted(seconds)
+    if not ordered:
+        return {'count': 0}
+
+    def percentile(p):
+        return 10**6 * ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+
+    return {
+        'count': len(ordered),
+        'total_s': sum(ordered),
+        'mean_us': 10**6 * sum(ordered) / len(ordered),
+        'p50_us': percentile(0.50),
+        'p95_us': percentile(0.95),
+    }
+
+
+def measure_functions(statements, table_descriptions):
+    """Time the transform functions on statements, a list of lists of
+    EntryRows, and return the call summary of each.
+    """
+    perf_counter = time.perf_counter
+    plans = [make_feature_table.compile_table_description(t)
+             for t in table_descriptions]
+    texts = set(table_concepts('feature_table_regnskabstekst.json'))
+    calls = {name: [] for name in ('filter_reporting_period', 'populate_row',
+                                   'generic_number', 'get_most_precise',
+                                   'generic_text', 'find_currency')}
+    for statement in statements:
+        start = perf_counter()
+        entries = filter_reporting_period(statement)
+        calls['filter_reporting_period'].append(perf_counter() - start)
+
+        fs_id = statement[0].financial_statement_id
+        for table_description, plan in zip(table_descriptions, plans):
+            start = perf_counter()
+            make_feature_table.populate_row(table_description, entries,
+                                            fs_id, plan=plan)
+            calls['populate_row'].append(perf_counter() - start)
+
+        fs_dict = make_feature_table.make_fs_dict(entries)
+        start = perf_counter()
+        make_feature_table.find_currency(fs_dict)
+        calls['find_currency'].append(perf_counter() - start)
+        for fieldName, values in fs_dict.items():
+            if fieldName in texts:
+                start = perf_counter()
+                make_feature_table.generic_text(fs_dict, fieldName)
+                calls['generic_text'].append(perf_counter() - start)
+                continue
+            if values[0].numericValue is None:
+                continue
+            start = perf_counter()
+            make_feature_table.generic_number(fs_dict, fieldName)
+            calls['generic_number'].append(perf_counter() - start)
+            values = list(values)
+            start = perf_counter()
+            make_feature_table.get_most_precise(values)
+            calls['get_most_precise'].append(perf_counter() - start)
+    return {name: call_summary(seconds) for name, seconds in calls.items()}
+
+
+def measure_transform(args):
+    """Fill a temporary SQLite database with a synthetic corpus and time the
+    transform of it.
+    """
+    database = os.path.join(tempfile.mkdtemp(), 'bench_transform.db')
+    setup_database_connection('sqlite:///%s' % database)
+    fetch.setup_tables()
+    corpus = make_corpus(args.filings, args.facts, args.consolidated_share,
+                         seed=args.seed)
+    for filing in corpus:
+        published = datetime.datetime.strptime(
+            filing['offentliggoerelsesTidspunkt'], '%Y-%m-%dT%H:%M:%S'
+        )
+        regnskab = SimpleNamespace(cvrnummer=filing['cvrnummer'],
+                                   erst_id=filing['erst_id'],
+                                   offentliggoerelsesTidspunkt=published,
+                                   indlaesningsTidspunkt=published,
+                                   xbrl_file_contents=filing['contents'])
+        insert_parsed([parse_regnskab(regnskab)])
+
+    table_definition_files = [str(resources / filename)
+                              for filename in TABLE_DEFINITION_FILES]
+    start = time.perf_counter()
+    make_feature_table.main(table_definition_files, args.processes)
+    elapsed = time.perf_counter() - start
+    os.remove(database)
+    return {
+        'filings': len(corpus),
+        'facts': args.facts,
+        'processes': args.processes,
+        'seconds': elapsed,
+        'statements_per_second': len(corpus) / elapsed if elapsed else None,
+    }
+
+
+def run(args):
+    rng = random.Random(args.seed)
+    statements = [make_statement(fs_id, args.entries, args.dimensions_share,
+                                 args.consolidated_share, rng)
+                  for fs_id in range(1, args.statements + 1)]
+    functions = measure_functions(statements, load_table_descriptions())
+    transform = None
+    if not args.skip_transform:
+        transform = measure_transform(args)
+    return {
+        'benchmark': 'transform',
+        'time': datetime.datetime.now().isoformat(),
+        'statements': args.statements,
+        'entries': args.entries,
+        'dimensions_share': args.dimensions_share,
+        'consolidated_share': args.consolidated_share,
+        'seed': args.seed,
+        'functions': functions,
+        'transform': transform,
+    }
+
+
+def print_report(result):
+    print('%-25s %8s %10s %10s %10s' % ('function', 'calls', 'mean us',
+                                        'p50 us', 'p95 us'))
+    for name, summary in result['functions'].items():
+        if not summary['count']:
+            continue
+        print('%-25s %8d %10.1f %10.1f %10.1f' % (
+            name, summary['count'], summary['mean_us'], summary['p50_us'],
+            summary['p95_us']))
+    if result['transform']:
+        print('transform of %(filings)s filings with %(processes)s processes '
+              'in %(seconds).2f s: %(statements_per_second).1f '
+              'statements/s' % result['transform'])
+
+
+def load_baseline(path):
+    """Returns the last transform result in the JSON lines file path."""
+    baseline = None
+    with open(path) as fp:
+        for line in fp:
+            if not line.strip():
+                continue
+            result = json.loads(line)
+            if result.get('benchmark') == 'transform':
+                baseline = result
+    return baseline
+
+
+def compare(result, baseline, threshold):
+    """Print the change of each benchmark from baseline and return the names
+    of those that got slower by more than threshold, e.g. 0.1 for 10%.
+    """
+    changes = []
+    for name, summary in result['functions'].items():
+        before = baseline['functions'].get(name, {})
+        if summary.get('count') and before.get('count'):
+            changes.append((name, before['mean_us'], summary['mean_us']))
+    if result['transform'] and baseline.get('transform'):
+        # compared as seconds per statement, so that lower is better.
+        changes.append((
+            'transform',
+            1 / baseline['transform']['statements_per_second'],
+            1 / result['transform']['statements_per_second']
+        ))
+
+    regressions = []
+    print('%-25s %9s' % ('compared to baseline', 'change'))
+    for name, before, after in changes:
+        change = after / before - 1
+        mark = ''
+        if change > threshold:
+            regressions.append(name)
+            mark = 'REGRESSION'
+        print('%-25s %+8.1f%% %s' % (name, 100 * change, mark))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--statements', type=int, default=1000,
+                        help=('Number of synthetic financial statements the '
+                              'functions are timed on.'))
+    parser.add_argument('--entries', type=int, default=300,
+                        help='Number of entries per synthetic statement.')
+    parser.add_argument('--dimensions-share', dest='dimensions_share',
+                        type=float, default=0.05,
+                        help='Share of the entries with dimensions.')
+    parser.add_argument('--consolidated-share', dest='consolidated_share',
+                        type=float, default=0.1,
+                        help='Share of the entries reported for the group.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--filings', type=int, default=200,
+                        help=('Number of synthetic filings transformed end '
+                              'to end.'))
+    parser.add_argument('--facts', type=int, default=300,
+                        help='Number of facts per synthetic filing.')
+    parser.add_argument('-p', '--processes', type=int, default=1)
+    parser.add_argument('--skip-transform', dest='skip_transform',
+                        action='store_true',
+                        help='Only time the functions.')
+    parser.add_argument('-o', '--output', default=None,
+                        help='Append the result as a JSON line to this file.')
+    parser.add_argument('--baseline', default=None,
+                        help=('Compare with the last result in this JSON '
+                              'lines file.'))
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help=('Slowdown relative to the baseline reported as '
+                              'a regression.'))
+    args = parser.parse_args(argv)
+
+    baseline = None
+    if args.baseline:
+        baseline = load_baseline(args.baseline)
+        if baseline is None:
+            print('No transform results in %s.' % args.baseline,
+                  file=sys.stderr)
+    result = run(args)
+    print_report(result)
+    if args.output:
+        with open(args.output, 'a') as fp:
+            print(json.dumps(result), file=fp)
+    if baseline is not None and compare(result, baseline, args.threshold):
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
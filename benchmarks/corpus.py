@@ -0,0 +1,175 @@
+""" Synthetic xbrl files used by the fetch benchmarks.
+
+The concepts are taken from the table definitions shipped with regnskaber, so
+the generated financial statements also exercise the transform.
+"""
+import datetime
+import json
+import random
+
+from pathlib import Path
+from xml.sax.saxutils import escape
+
+from regnskaber.document_cache import DocumentCache
+
+resources = Path(__file__).parent.parent / 'regnskaber' / 'resources'
+
+NAMESPACES = {
+    'xbrli': 'http://www.xbrl.org/2003/instance',
+    'link': 'http://www.xbrl.org/2003/linkbase',
+    'xlink': 'http://www.w3.org/1999/xlink',
+    'iso4217': 'http://www.xbrl.org/2003/iso4217',
+    'xbrldi': 'http://xbrl.org/2006/xbrldi',
+    'arr': 'http://xbrl.dcca.dk/arr',
+    'cmn': 'http://xbrl.dcca.dk/cmn',
+    'fsa': 'http://xbrl.dcca.dk/fsa',
+    'gsd': 'http://xbrl.dcca.dk/gsd',
+    'mrv': 'http://xbrl.dcca.dk/mrv',
+    'sob': 'http://xbrl.dcca.dk/sob',
+}
+
+SCHEMA_URL = ('http://archprod.service.eogs.dk/taxonomy/20130401/'
+              'entryDanishGAAPBalanceSheetAccountFormIncomeStatementByNature'
+              'IncludingManagementsReviewStatisticsAndTax20130401.xsd')
+
+# concepts make_xbrl reports itself, with well-formed values.
+FIXED_CONCEPTS = frozenset([
+    'gsd:ReportingPeriodStartDate',
+    'gsd:ReportingPeriodEndDate',
+    'gsd:IdentificationNumberCvrOfReportingEntity',
+])
+
+
+def table_concepts(filename):
+    with open(str(resources / filename)) as fp:
+        table_descriptions = json.load(fp)
+    return sorted(set(column['regnskabs_fieldname']
+                      for t in table_descriptions
+                      for column in t['columns']
+                      if column['regnskabs_fieldname'].split(':')[0]
+                      in NAMESPACES and
+                      column['regnskabs_fieldname'] not in FIXED_CONCEPTS))
+
+
+def context(context_id, cvrnummer, start_date, end_date, consolidated):
+    if start_date is None:
+        period = '<xbrli:instant>%s</xbrli:instant>' % end_date
+    else:
+        period = ('<xbrli:startDate>%s</xbrli:startDate>'
+                  '<xbrli:endDate>%s</xbrli:endDate>' % (start_date, end_date))
+    segment = ''
+    if consolidated:
+        segment = ('<xbrli:segment><xbrldi:explicitMember '
+                   'dimension="cmn:ConsolidatedSoloDimension">'
+                   'cmn:ConsolidatedMember</xbrldi:explicitMember>'
+                   '</xbrli:segment>')
+    return ('<xbrli:context id="%s"><xbrli:entity>'
+            '<xbrli:identifier scheme="http://www.dcca.dk/cvr">%s'
+            '</xbrli:identifier>%s</xbrli:entity>'
+            '<xbrli:period>%s</xbrli:period></xbrli:context>') % (
+                context_id, cvrnummer, segment, period)
+
+
+def make_xbrl(cvrnummer, year, facts, consolidated_share=0.1, rng=random):
+    """Returns an xbrl instance document with about facts facts.
+
+    A share of consolidated_share of the numeric facts is also reported for
+    the group.
+
+    """
+    start_date = datetime.date(year, 1, 1)
+    end_date = datetime.date(year, 12, 31)
+    previous_start = datetime.date(year - 1, 1, 1)
+    previous_end = datetime.date(year - 1, 12, 31)
+    contexts = [
+        context('c_duration', cvrnummer, start_date, end_date, False),
+        context('c_instant', cvrnummer, None, end_date, False),
+        context('c_previous', cvrnummer, previous_start, previous_end, False),
+        context('c_previous_instant', cvrnummer, None, previous_end, False),
+        context('c_group', cvrnummer, start_date, end_date, True),
+    ]
+    lines = [
+        '<?xml version="1.0" encoding="UTF-8"?>',
+        '<xbrli:xbrl %s>' % ' '.join('xmlns:%s="%s"' % item
+                                     for item in sorted(NAMESPACES.items())),
+        '<link:schemaRef xlink:type="simple" xlink:href="%s"/>' % SCHEMA_URL,
+    ]
+    lines.extend(contexts)
+    lines.append('<xbrli:unit id="DKK">'
+                 '<xbrli:measure>iso4217:DKK</xbrli:measure></xbrli:unit>')
+    lines.append('<gsd:ReportingPeriodStartDate contextRef="c_duration">'
+                 '%s</gsd:ReportingPeriodStartDate>' % start_date)
+    lines.append('<gsd:ReportingPeriodEndDate contextRef="c_duration">'
+                 '%s</gsd:ReportingPeriodEndDate>' % end_date)
+    lines.append('<gsd:IdentificationNumberCvrOfReportingEntity '
+                 'contextRef="c_duration">%s'
+                 '</gsd:IdentificationNumberCvrOfReportingEntity>'
+                 % cvrnummer)
+
+    numbers = table_concepts('feature_table_regnskabstal.json')
+    texts = table_concepts('feature_table_regnskabstekst.json')
+    instant_concepts = set(numbers[::3])
+    for i in range(max(facts - 3, 0)):
+        if rng.random() < 0.8:
+            concept = rng.choice(numbers)
+            # a concept is either reported for a period or at an instant.
+            if concept in instant_concepts:
+                context_ref = rng.choice(['c_instant', 'c_previous_instant'])
+            else:
+                context_ref = rng.choice(['c_duration', 'c_previous'])
+            if rng.random() < consolidated_share:
+                context_ref = 'c_group'
+            decimals = rng.choice(['0', '-3', '-6', 'INF'])
+            lines.append('<%s contextRef="%s" unitRef="DKK" decimals="%s">'
+                         '%d</%s>' % (concept, context_ref, decimals,
+                                      rng.randint(-10**7, 10**8), concept))
+        else:
+            concept = rng.choice(texts)
+            text = ' '.join(rng.choice(['Selskabet', 'har', 'i', 'året',
+                                        'haft', 'et', 'overskud', 'på'])
+                            for _ in range(rng.randint(5, 200)))
+            lines.append('<%s contextRef="c_duration">%s</%s>' % (
+                concept, escape(text), concept))
+    lines.append('</xbrli:xbrl>')
+    return '\n'.join(lines)
+
+
+def make_corpus(filings, facts, consolidated_share=0.1, seed=0):
+    """Returns a list of filings, each a dict with the metadata found in the
+    offentliggoerelser index and the xbrl file as 'contents'.
+    """
+    rng = random.Random(seed)
+    published = datetime.datetime(2014, 3, 1)
+    corpus = []
+    for i in range(filings):
+        cvrnummer = 10000000 + rng.randint(0, filings // 3 + 1)
+        year = rng.randint(2012, 2017)
+        published += datetime.timedelta(minutes=rng.randint(1, 600))
+        corpus.append({
+            'erst_id': 'bench%08d' % i,
+            'cvrnummer': cvrnummer,
+            'offentliggoerelsesTidspunkt': published.isoformat(),
+            'indlaesningsTidspunkt': published.isoformat(),
+            'contents': make_xbrl(cvrnummer, year, facts,
+                                  consolidated_share, rng),
+        })
+    return corpus
+
+
+def load_corpus(cache_dir):
+    """Returns the filings in a regnskaber.document_cache directory in the
+    format of make_corpus, e.g. real xbrl files from a fetch --cache-dir.
+    """
+    document_cache = DocumentCache(cache_dir)
+    corpus = []
+    for msg in document_cache.messages():
+        cvrnummer, offentliggoerelsesTidspunkt, _, _, erst_id = msg[:5]
+        corpus.append({
+            'erst_id': erst_id,
+            'cvrnummer': cvrnummer,
+            'offentliggoerelsesTidspunkt': offentliggoerelsesTidspunkt,
+            'indlaesningsTidspunkt': msg[5],
+            'contents': document_cache.get(erst_id),
+        })
+    corpus.sort(key=lambda filing: filing['offentliggoerelsesTidspunkt'])
+    return corpus
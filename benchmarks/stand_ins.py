@@ -0,0 +1,179 @@
+""" Local stand-ins for the erst Elasticsearch index and document server.
+
+A single HTTP server answers the scan/scroll requests made by
+regnskaber.fetch.get_virk_search and serves the xbrl files the hits point
+to, so fetch_to_db can run end to end without network access.
+"""
+import json
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+def find_gte(body):
+    """Returns the first 'gte' bound in an Elasticsearch query body."""
+    if isinstance(body, dict):
+        if 'gte' in body:
+            return body['gte']
+        values = body.values()
+    elif isinstance(body, list):
+        values = body
+    else:
+        return None
+    for value in values:
+        found = find_gte(value)
+        if found is not None:
+            return found
+    return None
+
+
+class StandInServer:
+    """Serves the filings of a corpus, see corpus.make_corpus.
+
+    latency -- seconds to wait before answering each document request, to
+               mimic a remote server.
+
+    """
+
+    def __init__(self, corpus, latency=0.0):
+        self.corpus = sorted(corpus,
+                             key=lambda f: f['offentliggoerelsesTidspunkt'])
+        self.documents = {f['erst_id']: f['contents'].encode('utf-8')
+                          for f in self.corpus}
+        self.latency = latency
+        self._scrolls = {}
+        self._scrolls_lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0),
+                                           self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return 'http://%s:%s' % (host, port)
+
+    def document_url(self, erst_id):
+        return '%s/documents/%s.xml' % (self.url, erst_id)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def hit(self, filing):
+        return {
+            '_index': 'offentliggoerelser',
+            '_type': 'offentliggoerelse',
+            '_id': filing['erst_id'],
+            '_score': None,
+            '_source': {
+                'cvrNummer': filing['cvrnummer'],
+                'offentliggoerelsesTidspunkt':
+                    filing['offentliggoerelsesTidspunkt'] + 'Z',
+                'indlaesningsTidspunkt':
+                    filing['indlaesningsTidspunkt'] + 'Z',
+                'dokumenter': [{
+                    'dokumentUrl': self.document_url(filing['erst_id']),
+                    'dokumentMimeType': 'application/xml',
+                    'dokumentType': 'AARSRAPPORT',
+                }],
+            },
+        }
+
+    def search(self, body, params):
+        """Start a scroll over the filings matching body."""
+        gte = find_gte(body)
+        filings = [f for f in self.corpus
+                   if gte is None or f['offentliggoerelsesTidspunkt'] >= gte]
+        size = int(params.get('size', ['10'])[0])
+        with self._scrolls_lock:
+            scroll_id = str(len(self._scrolls))
+            self._scrolls[scroll_id] = (filings, size, 0)
+        if params.get('search_type', [''])[0] == 'scan':
+            return self._page(scroll_id, [], len(filings))
+        return self.scroll(scroll_id)
+
+    def scroll(self, scroll_id):
+        with self._scrolls_lock:
+            filings, size, offset = self._scrolls[scroll_id]
+            self._scrolls[scroll_id] = (filings, size, offset + size)
+        page = [self.hit(f) for f in filings[offset:offset + size]]
+        return self._page(scroll_id, page, len(filings))
+
+    @staticmethod
+    def _page(scroll_id, hits, total):
+        return {
+            '_scroll_id': scroll_id,
+            'took': 1,
+            'timed_out': False,
+            '_shards': {'total': 1, 'successful': 1, 'failed': 0},
+            'hits': {'total': total, 'max_score': None, 'hits': hits},
+        }
+
+    def _make_handler(self):
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # the headers and body are sent in separate writes, which Nagle's
+            # algorithm delays by ~40 ms on a kept-alive connection.
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send(self, status, payload, content_type):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def _send_json(self, data):
+                self._send(200, json.dumps(data).encode('utf-8'),
+                           'application/json; charset=UTF-8')
+
+            def do_GET(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length).decode('utf-8')
+                url = urlparse(self.path)
+                params = parse_qs(url.query)
+                if url.path.startswith('/documents/'):
+                    erst_id = url.path[len('/documents/'):-len('.xml')]
+                    if stand_in.latency:
+                        time.sleep(stand_in.latency)
+                    document = stand_in.documents.get(erst_id)
+                    if document is None:
+                        self._send(404, b'', 'text/plain')
+                    else:
+                        self._send(200, document,
+                                   'application/xml; charset=utf-8')
+                elif url.path.endswith('/_search/scroll'):
+                    scroll_id = params.get('scroll_id', [body])[0]
+                    self._send_json(stand_in.scroll(scroll_id.strip()))
+                elif url.path.endswith('/_search'):
+                    query = json.loads(body) if body else {}
+                    self._send_json(stand_in.search(query, params))
+                else:
+                    self._send_json({})
+
+            do_POST = do_GET
+
+            def do_HEAD(self):
+                self._send(200, b'', 'application/json')
+
+        return Handler
@@ -110,13 +110,20 @@ def read_config():
         return config
 
 
-def setup_database_connection():
+def setup_database_connection(connection_url=None):
+    """Setup engine and Session.
+
+    connection_url -- an SQLAlchemy database url to use instead of the one in
+                      the configuration file, e.g. sqlite:///regnskaber.db.
+
+    """
     global _engine, _session
 
-    config = read_config()
-    connection_url = ("{sql_type}://{user}:{passwd}@{host}:{port}/"
-                      "{database}?charset={charset}")
-    connection_url = connection_url.format(**config['Global'])
+    if connection_url is None:
+        config = read_config()
+        connection_url = ("{sql_type}://{user}:{passwd}@{host}:{port}/"
+                          "{database}?charset={charset}")
+        connection_url = connection_url.format(**config['Global'])
     _engine = create_engine(connection_url, encoding='utf-8')
     _session = sessionmaker(bind=engine)
 
@@ -5,29 +5,64 @@ from . import (interactive_ensure_config_exists, setup_database_connection,
                parse_date, interactive_configure_connection)
 
 from . import fetch
+from . import migrations
+from . import profiling
 from . import make_feature_table as transform
 
 
 class Commands:
     @staticmethod
-    def fetch(from_date, processes, **general_options):
+    def fetch(from_date, processes, download_threads, writers, incremental,
+              batch_size, cache_dir, from_cache, metrics_file,
+              metrics_format, metrics_interval, **general_options):
+        if from_cache and cache_dir is None:
+            parser.error('--from-cache requires --cache-dir')
         interactive_ensure_config_exists()
         # setup engine and Session.
         setup_database_connection()
-        fetch.fetch_to_db(processes, from_date)
+        fetch.fetch_to_db(processes, from_date,
+                          download_threads=download_threads,
+                          incremental=incremental,
+                          insert_batch_size=batch_size,
+                          cache_dir=cache_dir,
+                          from_cache=from_cache,
+                          writer_count=writers,
+                          metrics_file=metrics_file,
+                          metrics_format=metrics_format,
+                          metrics_interval=metrics_interval)
 
     @staticmethod
-    def transform(table_definition_file, **general_options):
+    def transform(table_definition_files, processes, incremental,
+                  parquet_dir, memory_limit, **general_options):
+        if incremental and parquet_dir is not None:
+            parser.error('--incremental cannot be used with --parquet-dir')
         interactive_ensure_config_exists()
         # setup engine and Session.
         setup_database_connection()
-        transform.main(table_definition_file)
+        if memory_limit is not None:
+            memory_limit = memory_limit * 2**20
+        transform.main(table_definition_files, processes, incremental,
+                       parquet_dir, memory_limit)
+
+    @staticmethod
+    def migrate(batch_size, **general_options):
+        interactive_ensure_config_exists()
+        # setup engine and Session.
+        setup_database_connection()
+        migrations.migrate(batch_size)
 
     @staticmethod
     def reconfigure(**general_options):
         interactive_configure_connection()
 
 parser = argparse.ArgumentParser()
+parser.add_argument('--profile',
+                    dest='profile',
+                    metavar='DIRECTORY',
+                    help=('Profile the command with cProfile, and each of '
+                          'its processes, writing the profiles and a '
+                          'report.txt summarizing them to DIRECTORY.'),
+                    default=None)
 
 subparsers = parser.add_subparsers(dest='command')
 subparsers.required = True
@@ -42,17 +77,117 @@ parser_fetch.add_argument('-f', '--from-date',
 
 parser_fetch.add_argument('-p', '--processes',
                           dest='processes',
-                          help=('The number of parallel jobs to start.'),
+                          help=('The number of processes parsing xbrl '
+                                'files.'),
+                          type=int,
+                          default=1)
+
+parser_fetch.add_argument('-d', '--download-threads',
+                          dest='download_threads',
+                          help=('The number of concurrent downloads.'),
+                          type=int,
+                          default=8)
+
+parser_fetch.add_argument('-w', '--writers',
+                          dest='writers',
+                          help=('The number of processes inserting into the '
+                                'database.'),
                           type=int,
                           default=1)
 
+parser_fetch.add_argument('-i', '--incremental',
+                          dest='incremental',
+                          help=('Resume from the checkpoint saved by the '
+                                'previous fetch instead of --from-date.'),
+                          action='store_true')
+
+parser_fetch.add_argument('-b', '--batch-size',
+                          dest='batch_size',
+                          help=('The number of financial statements inserted '
+                                'per transaction.'),
+                          type=int,
+                          default=10)
+
+parser_fetch.add_argument('-c', '--cache-dir',
+                          dest='cache_dir',
+                          help=('Directory where downloaded xbrl files are '
+                                'cached and read from.'),
+                          default=None)
+
+parser_fetch.add_argument('--from-cache',
+                          dest='from_cache',
+                          help=('Insert the financial statements in the cache '
+                                'directory without any network access.'),
+                          action='store_true')
+
+parser_fetch.add_argument('--metrics-file',
+                          dest='metrics_file',
+                          help=('Write counters and latency histograms of '
+                                'each stage to this file.'),
+                          default=None)
+
+parser_fetch.add_argument('--metrics-format',
+                          dest='metrics_format',
+                          help=('jsonl appends a JSON line per report, '
+                                'prometheus writes a Prometheus textfile.'),
+                          choices=['jsonl', 'prometheus'],
+                          default='jsonl')
+
+parser_fetch.add_argument('--metrics-interval',
+                          dest='metrics_interval',
+                          help=('Seconds between metrics reports.'),
+                          type=float,
+                          default=60)
+
 parser_transform = subparsers.add_parser('transform',
                                          help=('build useful tables from data '
                                                'fetched from erst.'))
-parser_transform.add_argument('table_definition_file', type=str,
-                              help=('A file that specifies the table to be '
-                                    'created. If the table name already '
-                                    'exists, it is first deleted.'))
+parser_transform.add_argument('table_definition_files', type=str,
+                              nargs='+', metavar='table_definition_file',
+                              help=('A file that specifies the tables to be '
+                                    'created. If a table name already '
+                                    'exists, it is first deleted. All the '
+                                    'tables of the given files are built in '
+                                    'a single pass over the financial '
+                                    'statements.'))
+parser_transform.add_argument('-p', '--processes',
+                              dest='processes',
+                              help=('The number of processes, each '
+                                    'transforming a range of the financial '
+                                    'statements.'),
+                              type=int,
+                              default=1)
+parser_transform.add_argument('-i', '--incremental',
+                              dest='incremental',
+                              help=('Keep tables built from the same '
+                                    'definition and only add the financial '
+                                    'statements they are missing.'),
+                              action='store_true')
+parser_transform.add_argument('--parquet-dir',
+                              dest='parquet_dir',
+                              help=('Write the tables as Parquet datasets, '
+                                    'partitioned by year, in this directory '
+                                    'instead of to the database. Requires '
+                                    'pyarrow.'),
+                              default=None)
+parser_transform.add_argument('--memory-limit',
+                              dest='memory_limit',
+                              help=('The memory in MB the transform should '
+                                    'stay within, shared by its processes. '
+                                    'Entries are read in batches that fit '
+                                    'it.'),
+                              type=int,
+                              default=None)
+
+parser_migrate = subparsers.add_parser('migrate',
+                                       help=('Migrate a database created by '
+                                             'an earlier version.'))
+parser_migrate.add_argument('-b', '--batch-size',
+                            dest='batch_size',
+                            help=('The number of entries updated per '
+                                  'transaction.'),
+                            type=int,
+                            default=migrations.MIGRATE_BATCH_SIZE)
 
 parser_reconfigure = subparsers.add_parser('reconfigure',
                                            help='Reconfigure database info.')
@@ -60,4 +195,12 @@ parser_reconfigure = subparsers.add_parser('reconfigure',
 
 if __name__ == "__main__":
     args = vars(parser.parse_args())
-    getattr(Commands, args.pop('command'))(**args)
+    command = args.pop('command')
+    profile = args.pop('profile')
+    if profile is None:
+        getattr(Commands, command)(**args)
+    else:
+        profiling.setup_profiling(profile)
+        with profiling.profiled(command):
+            getattr(Commands, command)(**args)
+        print('Wrote profiling report to %s' % profiling.write_report())
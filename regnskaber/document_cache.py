@@ -0,0 +1,75 @@
+""" On-disk cache of the raw xbrl files fetched from erst. """
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+
+
+class DocumentCache:
+    """Stores the xbrl file of each financial statement gzip compressed,
+    keyed by erst_id.
+
+    Each file starts with a line holding the queue message of the financial
+    statement as JSON, followed by the xbrl file itself, so the cache alone is
+    enough to replay a fetch.  The files are spread over 256 subdirectories by
+    the sha1 of the erst_id.
+
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, erst_id):
+        digest = hashlib.sha1(erst_id.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest + '.xml.gz')
+
+    def __contains__(self, erst_id):
+        return os.path.exists(self._path(erst_id))
+
+    def get(self, erst_id):
+        """Returns the cached xbrl file of erst_id, or None if not cached."""
+        try:
+            with gzip.open(self._path(erst_id), 'rt', encoding='utf-8',
+                           newline='') as fp:
+                fp.readline()
+                return fp.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, message, xbrl_file_contents):
+        """Cache the xbrl file of the financial statement described by
+        message, see fetch.producer_scan for its format.
+        """
+        erst_id = message[4]
+        path = self._path(erst_id)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        # write to a temporary file first so readers never see half a file.
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as raw, \
+                    gzip.open(raw, 'wt', encoding='utf-8',
+                              newline='') as fp:
+                print(json.dumps(message), file=fp)
+                fp.write(xbrl_file_contents)
+            os.replace(tmp_path, path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+        return
+
+    def messages(self):
+        """Iterate over the queue messages of all cached financial
+        statements.
+        """
+        for entry in sorted(os.scandir(self.directory), key=lambda e: e.name):
+            if not entry.is_dir():
+                continue
+            for file_entry in os.scandir(entry.path):
+                if not file_entry.name.endswith('.xml.gz'):
+                    continue
+                with gzip.open(file_entry.path, 'rt', encoding='utf-8',
+                               newline='') as fp:
+                    yield tuple(json.loads(fp.readline()))
@@ -1,35 +1,92 @@
 import csv
-import functools
-import os
+import json
+import multiprocessing
 import sys
 import tempfile
-import time
+import threading
 
+from contextlib import contextmanager
 from datetime import datetime
-from multiprocessing import Process, Lock
+from multiprocessing import Process
+from queue import Empty
 
 import elasticsearch1
 import requests
 
 from elasticsearch1 import Elasticsearch
 from elasticsearch1_dsl import Search
+from requests.adapters import HTTPAdapter
 
-from .ioqueue import IOQueueManager
+from . import metrics
+from . import profiling
+from .document_cache import DocumentCache
+from .ioqueue import IOQueue
+from .migrations import upgrade_schema
 
-from .unitrefs import UnitHandler
-from .regnskab_inserter import drive_regnskab
+from .regnskab_inserter import drive_regnskab, parse_regnskab, insert_parsed
 
 from . import Session, engine, parse_date
-from .models import FinancialStatement, Base
+from .models import FinancialStatement, FetchCheckpoint, FetchRetry, Base
 
 ERASE = '\r\x1B[K'
 ENCODING = 'UTF-8'
 
 csv.field_size_limit(2**31-1)
 
+ELASTICSEARCH_URL = 'http://distribution.virk.dk:80'
+DOWNLOAD_TIMEOUT = 300  # seconds.
+CHECKPOINT_INTERVAL = 1000  # documents scanned between checkpoints.
+CHECKPOINT_NAME = 'fetch'
+
+_http_session = None
+_document_cache = None
+
+
+def setup_http_session(pool_size=1):
+    """Create the pooled HTTP session used for downloading xbrl files.
+
+    Must be called again in every process after forking, since connections
+    in the pool cannot be shared between processes.
+
+    pool_size -- the number of connections kept alive per host.  Should be at
+                 least the number of concurrent downloads.
+
+    """
+    global _http_session
+    if _http_session is not None:
+        _http_session.close()
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size,
+                          max_retries=3)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    _http_session = session
+    return session
+
+
+def get_http_session():
+    if _http_session is None:
+        return setup_http_session()
+    return _http_session
+
+
+def setup_document_cache(directory):
+    """Make InputRegnskab read and write xbrl files in a DocumentCache.
+
+    Call before forking the consumers.  A directory of None disables the
+    cache.
+
+    """
+    global _document_cache
+    if directory is None:
+        _document_cache = None
+    else:
+        _document_cache = DocumentCache(directory)
+    return _document_cache
+
 
 def setup_tables():
-    Base.metadata.create_all(engine)
+    upgrade_schema(Base.metadata)
     return
 
 
@@ -58,8 +115,11 @@ class InputRegnskabError(Exception):
 
 
 class InputRegnskab(object):
-    """Responsible for providing financial_statement data based on the xbrl_file
-    and its possible extension.
+    """Responsible for providing financial_statement data based on the
+    xbrl_file and its possible extension.
+
+    If a document cache is set up the xbrl file is read from the cache, and
+    downloaded files are added to it.
     """
 
     def __init__(self, cvrnummer, offentliggoerelsesTidspunkt,
@@ -70,7 +130,14 @@ class InputRegnskab(object):
         self.offentliggoerelsesTidspunkt = offentliggoerelsesTidspunkt
         self.indlaesningsTidspunkt = indlaesningsTidspunkt
         self.xbrl_file_url = xbrl_file_url
-        self.xbrl_file_contents = self._download_file(xbrl_file_url)
+        self.xbrl_extension_url = xbrl_extension_url
+        if _document_cache is not None:
+            self.xbrl_file_contents = _document_cache.get(erst_id)
+            if self.xbrl_file_contents is None:
+                self.xbrl_file_contents = self._download_file(xbrl_file_url)
+                _document_cache.put(self.message(), self.xbrl_file_contents)
+        else:
+            self.xbrl_file_contents = self._download_file(xbrl_file_url)
 
     def __enter__(self):
         return self
@@ -78,8 +145,15 @@ class InputRegnskab(object):
     def __exit__(self, exc_type, exc_value, traceback):
         pass
 
+    def message(self):
+        """Returns the queue message describing this financial statement."""
+        return (self.cvrnummer, self.offentliggoerelsesTidspunkt.isoformat(),
+                self.xbrl_file_url, self.xbrl_extension_url, self.erst_id,
+                self.indlaesningsTidspunkt.isoformat())
+
     def _download_file(self, xbrl_file_url):
-        response = requests.get(xbrl_file_url)
+        response = get_http_session().get(xbrl_file_url,
+                                          timeout=DOWNLOAD_TIMEOUT)
         if response.status_code != 200:
             error_msg = ('Status code when attempting to download file '
                          'was %s' % response.status_code)
@@ -100,8 +174,7 @@ class InputRegnskab(object):
 
 
 def query_by_erst_id(erst_id):
-    url = 'http://distribution.virk.dk:80'
-    client = Elasticsearch(url, timeout=300)
+    client = Elasticsearch(ELASTICSEARCH_URL, timeout=300)
     index = 'offentliggoerelser'
     search = Search(using=client, index=index).query(
         'match', _id=erst_id
@@ -119,19 +192,20 @@ def query_by_erst_id(erst_id):
 # fix temporary csv
 # insert csv into database.
 
-def process(cvrnummer, offentliggoerelsesTidspunkt, xbrl_file, xbrl_extension,
-            erst_id, indlaesningsTidspunkt, unit_handler):
-    if erst_id_present(erst_id):
-        return
+@contextmanager
+def report_errors(erst_id, stage='fetch'):
+    """Log errors raised while handling the financial statement erst_id
+    instead of propagating them.  Errors are counted in the metrics as
+    <stage>_errors.
+    """
     try:
-        with InputRegnskab(cvrnummer, offentliggoerelsesTidspunkt,
-                           xbrl_file, xbrl_extension, erst_id,
-                           indlaesningsTidspunkt) as regnskab:
-            drive_regnskab(regnskab)
+        yield
     except InputRegnskabError as e:
+        metrics.increment('%s_errors' % stage)
         with open('erst_data_errors.txt', 'a') as f:
             print(e, file=f, flush=True)
     except Exception as e:
+        metrics.increment('%s_errors' % stage)
         import traceback
         etype, exc, tb = sys.exc_info()
         msg = '[erst_id = %s] Caught Exception.\n' % erst_id
@@ -140,6 +214,54 @@ def process(cvrnummer, offentliggoerelsesTidspunkt, xbrl_file, xbrl_extension,
     return
 
 
+def download(cvrnummer, offentliggoerelsesTidspunkt, xbrl_file,
+             xbrl_extension, erst_id, indlaesningsTidspunkt):
+    """Download the financial statement and return it as an InputRegnskab.
+
+    Safe to call from several threads at once.  Financial statements already
+    in the database are not checked for here, as the producers skip the
+    erst_ids known when the fetch started, and the unique erst_id of
+    financial_statement rejects the insert of one inserted since.
+
+    """
+    return InputRegnskab(cvrnummer, offentliggoerelsesTidspunkt,
+                         xbrl_file, xbrl_extension, erst_id,
+                         indlaesningsTidspunkt)
+
+
+def insert_batch(queue, batch):
+    """Insert a batch of (item_id, msg, parsed) triples and mark their
+    messages done.
+
+    The batch is inserted in one transaction.  If that fails every financial
+    statement is retried in its own transaction, so one bad financial
+    statement only loses itself, and is recorded for the next incremental
+    fetch to retry.
+
+    """
+    inserted = False
+    if len(batch) > 1:
+        try:
+            with metrics.timed('insert'):
+                insert_parsed([parsed for _, _, parsed in batch])
+            inserted = True
+            metrics.increment('inserted', len(batch))
+        except Exception:
+            pass
+    if not inserted:
+        failed = []
+        for item_id, msg, parsed in batch:
+            with report_errors(msg[4], 'insert'):
+                with metrics.timed('insert'):
+                    insert_parsed([parsed])
+                metrics.increment('inserted')
+                continue
+            failed.append(msg)
+        record_failures(failed)
+    queue.task_done([item_id for item_id, _, _ in batch])
+    return
+
+
 def debug_by_erst_id(erst_id):
     # datetime_format = '%Y-%m-%dT%H:%M:%S.%f'
     hits, reponse = query_by_erst_id(erst_id)
@@ -186,6 +308,63 @@ def erst_id_present(erst_id):
         session.close()
 
 
+def record_failures(messages):
+    """Record the queue messages of financial statements that failed to
+    download, parse or insert, so the next incremental fetch retries them.
+    """
+    if not messages:
+        return
+    session = Session()
+    try:
+        for msg in messages:
+            session.merge(FetchRetry(erst_id=msg[4],
+                                     message=json.dumps(list(msg)),
+                                     failed=datetime.now()))
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+    return
+
+
+def enqueue_retries(queue, known_erst_ids):
+    """Put the financial statements recorded by record_failures in the
+    queue, and forget those that have been inserted since.
+
+    Returns the set of erst_ids put in the queue.
+
+    """
+    session = Session()
+    try:
+        retried = set()
+        for retry in session.query(FetchRetry):
+            if retry.erst_id in known_erst_ids:
+                session.delete(retry)
+                continue
+            queue.put(tuple(json.loads(retry.message)))
+            retried.add(retry.erst_id)
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+    metrics.increment('retried', len(retried))
+    return retried
+
+
+def load_known_erst_ids():
+    """Returns the set of erst_ids already present in the database."""
+    session = Session()
+    try:
+        q = session.query(FinancialStatement.erst_id).yield_per(10000)
+        return frozenset(erst_id for erst_id, in q)
+    finally:
+        session.close()
+
+
 def error_elastic_cvr_none(erst_id, offentliggoerelsesTidspunkt):
     msg = ("[erst_id = %s] [offentliggoerelsesTidspunkt: %s] "
            "Error: CVR-nummer returned by elasticsearch was None") % (
@@ -195,42 +374,121 @@ def error_elastic_cvr_none(erst_id, offentliggoerelsesTidspunkt):
     return
 
 
-def consumer_insert(queue, unit_handler=None, queue_lock=None):
-    engine.dispose()  # for multiprocessing.
-    if unit_handler is None:
-        unit_handler = UnitHandler()
-    while True:
-        do_sleep = False
-        try:
-            queue_lock.acquire()
-            if queue.size() == 0:
-                do_sleep = True
-                continue
-            msg = queue.get()
-            popped, pushed = queue.get_statistics()
-            print(ERASE + 'Inserting into db: %s/%s' % (popped, pushed),
-                  end='', flush=True)
-        finally:
-            queue_lock.release()
-            if do_sleep:
-                time.sleep(2)
+def qsize(q):
+    try:
+        return q.qsize()
+    except NotImplementedError:  # e.g. on macOS.
+        return None
+
 
+def print_progress(queue):
+    popped, pushed = queue.get_statistics()
+    print(ERASE + 'Inserting into db: %s/%s' % (popped, pushed),
+          end='', flush=True)
+    return
+
+
+def message_to_arguments(msg):
+    cvrnummer, offentliggoerelsesTidspunkt, xbrl_file_url = msg[:3]
+    xbrl_extension_url, erst_id, indlaesningsTidspunkt = msg[3:]
+    offentliggoerelsesTidspunkt = parse_date(offentliggoerelsesTidspunkt)
+    indlaesningsTidspunkt = parse_date(indlaesningsTidspunkt)
+    return (cvrnummer, offentliggoerelsesTidspunkt, xbrl_file_url,
+            xbrl_extension_url, erst_id, indlaesningsTidspunkt)
+
+
+def stage_download(queue, download_queue):
+    """Download stage of fetch_to_db, run in several threads.
+
+    Claims messages from queue and puts (item_id, msg, InputRegnskab)
+    triples in download_queue until it claims a 'DONE' message.
+
+    """
+    while True:
+        (item_id, msg), = queue.claim_many(1)
         if isinstance(msg, str) and msg == 'DONE':
+            queue.task_done([item_id])
             break
-        cvrnummer, offentliggoerelsesTidspunkt, xbrl_file_url = msg[:3]
-        xbrl_extension_url, erst_id, indlaesningsTidspunkt = msg[3:]
-        offentliggoerelsesTidspunkt = parse_date(offentliggoerelsesTidspunkt)
-        indlaesningsTidspunkt = parse_date(indlaesningsTidspunkt)
-        try:
-            if cvrnummer is None:
-                error_elastic_cvr_none(erst_id, offentliggoerelsesTidspunkt)
-                continue
-            process(cvrnummer, offentliggoerelsesTidspunkt, xbrl_file_url,
-                    xbrl_extension_url, erst_id, indlaesningsTidspunkt,
-                    unit_handler)
-        except Exception as e:
-            # already logged elsewhere.
-            pass
+        print_progress(queue)
+        arguments = message_to_arguments(msg)
+        cvrnummer, offentliggoerelsesTidspunkt = arguments[:2]
+        erst_id = arguments[4]
+        if cvrnummer is None:
+            error_elastic_cvr_none(erst_id, offentliggoerelsesTidspunkt)
+            queue.task_done([item_id])
+            continue
+        failed = True
+        with report_errors(erst_id, 'download'):
+            with metrics.timed('download'):
+                regnskab = download(*arguments)
+            failed = False
+        if failed:
+            record_failures([msg])
+            queue.task_done([item_id])
+            continue
+        metrics.increment('downloaded')
+        download_queue.put((item_id, msg, regnskab))
+    metrics.flush()
+    return
+
+
+def stage_parse(download_queue, parsed_queue):
+    """Parse stage of fetch_to_db, run in several processes.
+
+    Parses the xbrl files from download_queue and puts (item_id, msg,
+    parsed) triples in parsed_queue until it gets a 'DONE' message.  parsed
+    is None if the xbrl file could not be parsed.
+
+    """
+    while True:
+        item = download_queue.get()
+        if isinstance(item, str) and item == 'DONE':
+            break
+        item_id, msg, regnskab = item
+        parsed = None
+        with report_errors(regnskab.erst_id, 'parse'):
+            with regnskab, metrics.timed('parse'):
+                parsed = parse_regnskab(regnskab)
+            metrics.increment('parsed')
+        parsed_queue.put((item_id, msg, parsed))
+    metrics.flush()
+    return
+
+
+def stage_write(queue, parsed_queue, insert_batch_size=1):
+    """Write stage of fetch_to_db, run in one or a few processes.
+
+    Inserts the financial statements from parsed_queue insert_batch_size at
+    a time, and marks their messages done in queue, until it gets a 'DONE'
+    message.  Those that could not be parsed are recorded for the next
+    incremental fetch to retry.
+
+    """
+    engine.dispose()  # for multiprocessing.
+    done = False
+    while not done:
+        items = [parsed_queue.get()]
+        while len(items) < insert_batch_size:
+            try:
+                items.append(parsed_queue.get_nowait())
+            except Empty:
+                break
+        batch = []
+        failed = []
+        for item in items:
+            if isinstance(item, str) and item == 'DONE':
+                if done:
+                    parsed_queue.put(item)  # belongs to another writer.
+                done = True
+            elif item[2] is None:
+                failed.append(item)
+            else:
+                batch.append(item)
+        record_failures([msg for _, msg, _ in failed])
+        queue.task_done([item_id for item_id, _, _ in failed])
+        if batch:
+            insert_batch(queue, batch)
+    metrics.flush()
     return
 
 
@@ -253,16 +511,80 @@ def make_input_regnskab_from_search(s):
                          xbrl_extension_url, erst_id, indlaesningsTidspunkt)
 
 
-def producer_scan(search_result, queue, queue_lock=None):
-    for document in search_result.scan():
-        erst_id = document.meta.id
-        cvrnummer = document['cvrNummer']
-        # cvrnummer is possibly None, e.g. Greenland companies
+def load_checkpoint():
+    """Returns the FetchCheckpoint of the last fetch or None."""
+    session = Session()
+    try:
+        return session.query(FetchCheckpoint).get(CHECKPOINT_NAME)
+    finally:
+        session.close()
+
+
+def save_checkpoint(offentliggoerelsesTidspunkt, indlaesningsTidspunkt):
+    session = Session()
+    try:
+        checkpoint = FetchCheckpoint(
+            name=CHECKPOINT_NAME,
+            offentliggoerelsesTidspunkt=parse_date(
+                offentliggoerelsesTidspunkt
+            ),
+            indlaesningsTidspunkt=parse_date(indlaesningsTidspunkt),
+            updated=datetime.now()
+        )
+        session.merge(checkpoint)
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+    return
+
+
+def update_checkpoint(queue, last_scanned):
+    """Save the publication time up to which every scanned document has been
+    handled.  The documents that failed are recorded by record_failures, so
+    the checkpoint moves past them.
+
+    last_scanned -- (offentliggoerelsesTidspunkt, indlaesningsTidspunkt) of the
+                    last document scanned.
+
+    """
+    oldest = queue.oldest()
+    if oldest is None or isinstance(oldest, str):
+        # everything scanned so far has been handled.
+        save_checkpoint(*last_scanned)
+    else:
+        save_checkpoint(oldest[1], oldest[5])
+    return
+
+
+def producer_scan(search_result, queue, known_erst_ids=frozenset()):
+    """Put every financial statement of the search result in the queue.
+
+    Documents whose erst_id is in known_erst_ids are skipped.  Every
+    CHECKPOINT_INTERVAL documents the fetch checkpoint is moved to the oldest
+    document not yet handled by the consumers.
 
+    """
+    last_scanned = None
+    documents = metrics.timed_iter(search_result.scan(), 'scan')
+    for i, document in enumerate(documents):
+        metrics.increment('scanned')
+        erst_id = document.meta.id
         # date format: Y-m-dTH:M:s[Z+x]
         offentliggoerelsesTidspunkt = document['offentliggoerelsesTidspunkt']
         offentliggoerelsesTidspunkt = offentliggoerelsesTidspunkt[:19]
         indlaesningsTidspunkt = document['indlaesningsTidspunkt'][:19]
+        if last_scanned is not None and i % CHECKPOINT_INTERVAL == 0:
+            update_checkpoint(queue, last_scanned)
+        last_scanned = (offentliggoerelsesTidspunkt, indlaesningsTidspunkt)
+
+        if erst_id in known_erst_ids:
+            metrics.increment('skipped_known')
+            continue
+        cvrnummer = document['cvrNummer']
+        # cvrnummer is possibly None, e.g. Greenland companies
 
         dokumenter = document['dokumenter']
         xbrl_file_url = None
@@ -279,56 +601,148 @@ def producer_scan(search_result, queue, queue_lock=None):
         if xbrl_file_url is not None:
             msg = (cvrnummer, offentliggoerelsesTidspunkt, xbrl_file_url,
                    xbrl_extension_url, erst_id, indlaesningsTidspunkt)
-            queue_lock.acquire()
             queue.put(msg)
-            popped, pushed = queue.get_statistics()
-            print(ERASE + 'Inserting into db: %s/%s' % (popped, pushed),
-                  end='', flush=True)
-            queue_lock.release()
+            metrics.increment('enqueued')
+            print_progress(queue)
+    return last_scanned
+
+
+def producer_cache(document_cache, queue, known_erst_ids=frozenset()):
+    """Put every financial statement in document_cache in the queue.
+
+    Documents whose erst_id is in known_erst_ids are skipped.
+
+    """
+    for msg in metrics.timed_iter(document_cache.messages(), 'scan'):
+        metrics.increment('scanned')
+        if msg[4] in known_erst_ids:
+            metrics.increment('skipped_known')
+            continue
+        queue.put(msg)
+        metrics.increment('enqueued')
+        print_progress(queue)
     return
 
 
-def get_virk_search(from_date):
-    client = elasticsearch1.Elasticsearch('http://distribution.virk.dk:80',
-                                          timeout=300)
+def get_virk_search(from_date, elasticsearch_url=ELASTICSEARCH_URL):
+    client = elasticsearch1.Elasticsearch(elasticsearch_url, timeout=300)
     s = Search(using=client, index='offentliggoerelser')
     s = s.filter('range', offentliggoerelsesTidspunkt={'gte': from_date})
     s = s.sort('offentliggoerelsesTidspunkt')
+    # a plain scan ignores the sort, but the checkpoints rely on it.
+    s = s.params(preserve_order=True)
     return s
 
 
-def fetch_to_db(process_count=1, from_date=datetime(2011, 1, 1)):
-    setup_tables()
+def fetch_to_db(process_count=1, from_date=datetime(2011, 1, 1),
+                download_threads=1, incremental=False, insert_batch_size=1,
+                cache_dir=None, from_cache=False, writer_count=1,
+                elasticsearch_url=ELASTICSEARCH_URL, metrics_file=None,
+                metrics_format='jsonl', metrics_interval=60):
+    """Fetch financial statements published since from_date into the database.
+
+    The work is split in stages connected by bounded queues: the scan puts
+    messages in a persistent IOQueue, download_threads threads download the
+    xbrl files, process_count processes parse them, and writer_count
+    processes insert them insert_batch_size at a time.
+
+    If incremental is True and a previous fetch saved a checkpoint, the scan
+    resumes from the checkpoint instead of from_date.  The financial
+    statements that failed to download, parse or insert in earlier fetches
+    are queued again first, see record_failures.  The queue of scanned
+    messages is kept in a temporary file that is removed when the fetch
+    ends, also after an error, so resuming relies on the checkpoint and the
+    recorded failures alone.
 
-    unit_handler = UnitHandler()
-    s = get_virk_search(from_date)
+    If cache_dir is given the xbrl files are cached there.  With from_cache
+    the financial statements are read from the cache only, ignoring
+    from_date, and nothing is fetched over the network.
+
+    elasticsearch_url is the server of the offentliggoerelser index.  The xbrl
+    files are downloaded from the urls found in the index.
+
+    If metrics_file is given, counters and latency histograms of every stage
+    are written to it every metrics_interval seconds, as JSON lines or as a
+    Prometheus textfile depending on metrics_format.
+
+    """
+    if from_cache and cache_dir is None:
+        raise ValueError('from_cache requires a cache_dir.')
+    setup_tables()
+    document_cache = setup_document_cache(cache_dir)
+
+    if incremental and not from_cache:
+        checkpoint = load_checkpoint()
+        if checkpoint is not None:
+            from_date = checkpoint.offentliggoerelsesTidspunkt
+            print('Resuming from checkpoint %s' % from_date, flush=True)
+
+    known_erst_ids = load_known_erst_ids()
+    tmp_file = tempfile.NamedTemporaryFile(delete=False)
+    tmp_file.close()
+    queue = IOQueue(tmp_file.name)
+    collector = None
     try:
-        tmp_file = tempfile.NamedTemporaryFile(delete=False)
-        m = IOQueueManager()
-        m.start()
-        queue = m.IOQueue(tmp_file.name)
-        queue_lock = Lock()
-        consumer_partial = functools.partial(consumer_insert,
-                                             queue_lock=queue_lock,
-                                             unit_handler=unit_handler)
-
-        processes = [Process(target=consumer_partial,
-                             args=(queue,),
-                             daemon=True) for _ in range(process_count)]
-        for p in processes:
+        download_queue = multiprocessing.Queue(2 * process_count)
+        parsed_queue = multiprocessing.Queue(2 * writer_count *
+                                             insert_batch_size)
+        if metrics_file is not None:
+            def gauges():
+                return {'queued': queue.size(),
+                        'downloaded_queued': qsize(download_queue),
+                        'parsed_queued': qsize(parsed_queue)}
+            collector = metrics.setup_metrics(metrics_file, metrics_format,
+                                              metrics_interval, gauges)
+        parsers = [Process(target=profiling.profiled_target('fetch-parse',
+                                                            stage_parse),
+                           args=(download_queue, parsed_queue),
+                           daemon=True) for _ in range(process_count)]
+        writers = [Process(target=profiling.profiled_target('fetch-write',
+                                                            stage_write),
+                           args=(queue, parsed_queue, insert_batch_size),
+                           daemon=True) for _ in range(writer_count)]
+        for p in parsers + writers:
             p.start()
         engine.dispose()  # for multiprocessing.
-        producer_scan(s, queue, queue_lock=queue_lock)
 
-        queue_lock.acquire()
-        for end in range(process_count):
-            queue.put('DONE')
-        queue_lock.release()
-
-        for p in processes:
+        setup_http_session(download_threads)
+        downloaders = [threading.Thread(target=stage_download,
+                                        args=(queue, download_queue),
+                                        daemon=True)
+                       for _ in range(download_threads)]
+        for t in downloaders:
+            t.start()
+
+        last_scanned = None
+        if from_cache:
+            producer_cache(document_cache, queue,
+                           known_erst_ids=known_erst_ids)
+        else:
+            if incremental:
+                # queued here, so the scan must not queue them again.
+                known_erst_ids |= enqueue_retries(queue, known_erst_ids)
+            s = get_virk_search(from_date, elasticsearch_url)
+            last_scanned = producer_scan(s, queue,
+                                         known_erst_ids=known_erst_ids)
+
+        # shut down one stage at a time.
+        queue.put_many(['DONE'] * download_threads)
+        for t in downloaders:
+            t.join()
+        for p in parsers:
+            download_queue.put('DONE')
+        for p in parsers:
+            p.join()
+        for p in writers:
+            parsed_queue.put('DONE')
+        for p in writers:
             p.join()
 
+        if last_scanned is not None:
+            update_checkpoint(queue, last_scanned)
+
     finally:
-        os.remove(tmp_file.name)
-        pass
+        if collector is not None:
+            metrics.teardown_metrics(collector)
+        queue.remove()
     return
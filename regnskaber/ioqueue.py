@@ -1,78 +1,206 @@
 import json
-from multiprocessing import managers
+import multiprocessing
+import os
+import sqlite3
+import threading
 
 from queue import Empty
-import sys
+
 
 class IOQueue:
-    _buffer_size = 128  # elements.
+    """A persistent FIFO queue shared between processes.
+
+    Elements must be JSON serializable.  They are stored in an SQLite database
+    in WAL mode, so elements that have not been popped survive a restart when
+    the queue is reopened on the same file.  Every put and get is a single
+    SQLite transaction and needs no further locking.  A semaphore counts the
+    available elements, so a blocking get wakes up as soon as an element is
+    put.
+
+    Elements can also be claimed instead of removed.  A claimed element stays
+    in the database until it is acknowledged with task_done, and is made
+    available again when the queue is reopened, e.g. after a crash.
+
+    The queue must be created before forking the processes that use it.
+
+    """
 
     def __init__(self, filename):
-        self._push_buffer = []
-        self._pop_buffer = []
-        self._buffer_idx = 0
-        self._popped = 0
-        self._pushed = 0
         self._filename = filename
-        self._seek_to = 0
+        self._local = threading.local()
+        connection = self._connection()
+        connection.execute('CREATE TABLE IF NOT EXISTS queue ('
+                           'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                           'element TEXT NOT NULL, '
+                           'claimed INTEGER NOT NULL DEFAULT 0)')
+        # nobody holds the elements claimed before a restart.
+        connection.execute('UPDATE queue SET claimed = 0')
+        size, = connection.execute('SELECT COUNT(*) FROM queue').fetchone()
+        self._available = multiprocessing.Semaphore(size)
+        self._popped = multiprocessing.Value('q', 0)
+        self._pushed = multiprocessing.Value('q', size)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_local']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    def _connection(self):
+        """Returns the connection of the calling thread in this process."""
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            # connections must not be shared with a forked parent.
+            connection = sqlite3.connect(self._filename, timeout=60,
+                                         isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            local.connection = connection
+            local.pid = os.getpid()
+        return local.connection
 
     def get_statistics(self):
-        return self._popped, self._pushed
+        return self._popped.value, self._pushed.value
 
     def size(self):
-        return self._pushed - self._popped
+        return self._pushed.value - self._popped.value
 
-    def get(self):
-        if self._buffer_idx >= len(self._pop_buffer):
-            self._fill_pop_buffer()
-        if len(self._pop_buffer) > self._buffer_idx:
-            self._buffer_idx += 1
-            self._popped += 1
-            return self._pop_buffer[self._buffer_idx - 1]
-        raise Empty
+    def get(self, block=True, timeout=None):
+        """Remove and return the first element.
 
-    def put(self, element):
-        if len(self._push_buffer) >= IOQueue._buffer_size:
-            self._flush_buffer()
-        assert(len(self._push_buffer) < IOQueue._buffer_size)
-        self._push_buffer.append(element)
-        self._pushed += 1
-
-    def _fill_pop_buffer(self):
-        assert(self._buffer_idx >= len(self._pop_buffer))
-        if self.size() < IOQueue._buffer_size:
-            self._pop_buffer = [x for x in self._push_buffer]
-            self._push_buffer = []
-            self._buffer_idx = 0
-            return
+        Raises queue.Empty if no element became available in time.
+
+        """
+        if not self._available.acquire(block, timeout):
+            raise Empty
+        return self._pop(1)[0]
 
-        with open(self._filename) as qfile:
-            qfile.seek(self._seek_to)
-            contents = qfile.readline()
-            assert contents.endswith('\n')
-            self._seek_to = qfile.tell()
-
-            try:
-                self._pop_buffer = [x for x in json.loads(contents)]
-            except json.JSONDecodeError as e:
-                print(contents, file=sys.stderr)
-                raise
-            self._pop_buffer = [tuple(x) if type(x) == list else x
-                                 for x in self._pop_buffer]
-            self._buffer_idx = 0
+    def get_many(self, count, block=True, timeout=None):
+        """Remove and return a list of between 1 and count elements.
+
+        Only waits for the first element.  Raises queue.Empty if no element
+        became available in time.
+
+        """
+        if not self._available.acquire(block, timeout):
+            raise Empty
+        acquired = 1
+        while acquired < count and self._available.acquire(False):
+            acquired += 1
+        return self._pop(acquired)
+
+    def claim_many(self, count, block=True, timeout=None):
+        """Claim and return a list of between 1 and count (item_id, element)
+        pairs.  Each item_id must be passed to task_done when the element has
+        been handled.
+
+        Only waits for the first element.  Raises queue.Empty if no element
+        became available in time.
+
+        """
+        if not self._available.acquire(block, timeout):
+            raise Empty
+        acquired = 1
+        while acquired < count and self._available.acquire(False):
+            acquired += 1
+        return self._pop(acquired, claim=True)
+
+    def task_done(self, item_ids):
+        """Remove the claimed elements with the given item_ids."""
+        rows = [(item_id,) for item_id in item_ids]
+        if not rows:
             return
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.executemany('DELETE FROM queue WHERE id = ?', rows)
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+
+    def oldest(self):
+        """Returns the oldest element that is either available or claimed and
+        not yet done, or None if there is no such element.
+        """
+        row = self._connection().execute(
+            'SELECT element FROM queue ORDER BY id LIMIT 1'
+        ).fetchone()
+        if row is None:
+            return None
+        return self._decode(row[0])
 
-    def _flush_buffer(self):
-        assert(len(self._push_buffer) > 0)
-        with open(self._filename, 'a') as qfile:
-            to_write = json.dumps(self._push_buffer)
-            assert '\n' not in to_write
-            print(to_write, file=qfile)
-            self._push_buffer = []
+    def put(self, element):
+        self.put_many([element])
+
+    def put_many(self, elements):
+        rows = [(json.dumps(element),) for element in elements]
+        if not rows:
+            return
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.executemany('INSERT INTO queue (element) VALUES (?)',
+                                   rows)
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        with self._pushed.get_lock():
+            self._pushed.value += len(rows)
+        for _ in rows:
+            self._available.release()
 
+    def _pop(self, count, claim=False):
+        """Remove or claim the first count available elements.  The caller
+        must have acquired count elements from the semaphore.
+        """
+        connection = self._connection()
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+            rows = connection.execute(
+                'SELECT id, element FROM queue WHERE claimed = 0 '
+                'ORDER BY id LIMIT ?', (count,)
+            ).fetchall()
+            assert len(rows) == count
+            if claim:
+                statement = 'UPDATE queue SET claimed = 1 WHERE id = ?'
+            else:
+                statement = 'DELETE FROM queue WHERE id = ?'
+            connection.executemany(statement,
+                                   [(item_id,) for item_id, _ in rows])
+            connection.execute('COMMIT')
+        except Exception:
+            if connection.in_transaction:
+                connection.execute('ROLLBACK')
+            for _ in range(count):
+                self._available.release()
+            raise
+        with self._popped.get_lock():
+            self._popped.value += count
+        if claim:
+            return [(item_id, self._decode(element))
+                    for item_id, element in rows]
+        return [self._decode(element) for _, element in rows]
 
-class IOQueueManager(managers.BaseManager):
-    pass
+    @staticmethod
+    def _decode(element):
+        x = json.loads(element)
+        return tuple(x) if isinstance(x, list) else x
 
+    def close(self):
+        """Close the connection of the calling thread."""
+        if getattr(self._local, 'pid', None) == os.getpid():
+            self._local.connection.close()
+        self._local = threading.local()
 
-IOQueueManager.register('IOQueue', IOQueue)
+    def remove(self):
+        """Close the queue and delete its files."""
+        self.close()
+        for suffix in ('', '-wal', '-shm'):
+            path = self._filename + suffix
+            if os.path.exists(path):
+                os.remove(path)
@@ -0,0 +1,99 @@
+""" The lookup tables of the concepts, dimensions and units of entries.
+
+Entries refer to these by integer ids instead of repeating the strings.
+"""
+import hashlib
+
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+
+from . import engine
+from .models import Concept, DimensionSet, Unit
+
+# (entry value, entry id column, lookup model) of each lookup table.
+ENTRY_LOOKUPS = (
+    ('fieldName', 'conceptId', Concept),
+    ('dimensions', 'dimensionSetId', DimensionSet),
+    ('unitIdXbrl', 'unitId', Unit),
+)
+
+SELECT_CHUNK_SIZE = 500  # hashes per select.
+
+INSERT_RETRIES = 3
+
+_caches = {}
+
+
+def value_hash(value):
+    return hashlib.sha1(value.encode('utf-8')).hexdigest()
+
+
+class LookupCache(object):
+    """Maps the values of a lookup table to their ids, creating the rows of
+    values not seen before.  Several processes may create rows at once.
+    """
+
+    def __init__(self, model):
+        self.table = model.__table__
+        self.ids = {}
+
+    def get_ids(self, values):
+        """Returns a dict from value to id containing all of values, except
+        None.
+        """
+        missing = set(v for v in values
+                      if v is not None and v not in self.ids)
+        if missing:
+            self._load_or_create(missing)
+        return self.ids
+
+    def _select(self, hashes):
+        hash_list = list(hashes)
+        for i in range(0, len(hash_list), SELECT_CHUNK_SIZE):
+            q = select([self.table.c.hash, self.table.c.id]).where(
+                self.table.c.hash.in_(hash_list[i:i + SELECT_CHUNK_SIZE])
+            )
+            for value_hash, value_id in engine.execute(q):
+                self.ids[hashes[value_hash]] = value_id
+        return
+
+    def _load_or_create(self, values):
+        hashes = {value_hash(v): v for v in values}
+        for _ in range(INSERT_RETRIES):
+            self._select(hashes)
+            rows = [{'hash': h, 'value': v} for h, v in hashes.items()
+                    if v not in self.ids]
+            if not rows:
+                return
+            try:
+                engine.execute(self.table.insert(), rows)
+            except IntegrityError:
+                # another process inserted some of them, select again.
+                pass
+        self._select(hashes)
+        if any(v not in self.ids for v in values):
+            raise LookupError('Could not create the rows of %s.' %
+                              self.table.name)
+        return
+
+
+def get_lookup_cache(model):
+    """Returns the LookupCache of model, shared within the process."""
+    try:
+        return _caches[model]
+    except KeyError:
+        _caches[model] = cache = LookupCache(model)
+        return cache
+
+
+def resolve_entry_lookups(rows):
+    """Replace the fieldName, dimensions and unitIdXbrl of the entry dicts
+    in rows by the ids of the corresponding lookup rows.
+    """
+    for value_name, id_name, model in ENTRY_LOOKUPS:
+        ids = get_lookup_cache(model).get_ids(row[value_name]
+                                              for row in rows)
+        for row in rows:
+            value = row.pop(value_name)
+            row[id_name] = None if value is None else ids[value]
+    return rows
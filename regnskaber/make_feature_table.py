@@ -1,18 +1,32 @@
+import bisect
 import datetime
+import hashlib
 import json
-
-from itertools import groupby
+import multiprocessing
+import resource
+import shutil
+import sys
+
+from array import array
+from collections import OrderedDict, namedtuple
+from contextlib import closing
+from multiprocessing import Process
 from pprint import pprint
 
-from .shared import financial_statement_iterator, partition_consolidated
+from .shared import (financial_statement_iterator, get_end_idx,
+                     get_number_of_rows, parse_decimals,
+                     partition_consolidated)
 
 from sqlalchemy import Table, Column, ForeignKey, MetaData
 from sqlalchemy import DateTime, String, Text
-from sqlalchemy import Sequence, UniqueConstraint
+from sqlalchemy import Sequence, UniqueConstraint, and_, exists, select
 from sqlalchemy import BigInteger, Boolean, Float, Integer
 
 
-from .models import Base
+from .migrations import ensure_migrated, upgrade_schema
+from .models import Base, DECIMALS_INF, FinancialStatement
+from .parquet_sink import ParquetSink
+from . import profiling
 from . import Session, engine
 
 current_regnskabs_id = 0
@@ -154,15 +168,147 @@ class Header(Base):
     )
 
 
-def make_header(fs_dict, financial_statement_id, consolidated, session):
-    instance = session.query(Header).filter(
-        Header.financial_statement_id == financial_statement_id,
-        Header.consolidated == consolidated
-    ).first()
+class FeatureTableDefinition(Base):
+    """The definition a feature table was last built from, see
+    definition_hash.
+    """
+    __tablename__ = 'feature_table_definition'
+    tablename = Column(String(100), primary_key=True)
+    definition_hash = Column(String(40))
+    updated = Column(DateTime)
+
+
+class FeatureTableStatement(Base):
+    """A financial statement a feature table has been populated with, whether
+    or not it gave the table any rows, see missing_financial_statement_ids.
+    """
+    __tablename__ = 'feature_table_statement'
+    tablename = Column(String(100), primary_key=True)
+    financial_statement_id = Column(Integer, primary_key=True,
+                                    autoincrement=False)
+
+
+def definition_hash(table_description):
+    """Returns a hash of table_description that changes whenever the table
+    it defines changes.
+    """
+    definition = json.dumps(table_description, sort_keys=True)
+    return hashlib.sha1(definition.encode('utf-8')).hexdigest()
+
+
+def is_up_to_date(table_description, table):
+    """Returns whether table exists and was built from table_description."""
+    if not table.exists(engine):
+        return False
+    with closing(Session()) as session:
+        definition = session.query(FeatureTableDefinition).get(
+            table_description['tablename']
+        )
+        return (definition is not None and
+                definition.definition_hash ==
+                definition_hash(table_description))
+
+
+def save_definitions(table_descriptions):
+    with closing(Session()) as session:
+        for table_description in table_descriptions:
+            session.merge(FeatureTableDefinition(
+                tablename=table_description['tablename'],
+                definition_hash=definition_hash(table_description),
+                updated=datetime.datetime.now()
+            ))
+        session.commit()
+    return
+
+
+def is_recorded(table, financial_statement_id):
+    """Returns the clause of financial_statement_id having been recorded as
+    populated in table, see record_statements.
+    """
+    recorded = FeatureTableStatement.__table__
+    return exists(select([recorded.c.financial_statement_id]).where(and_(
+        recorded.c.tablename == table.name,
+        recorded.c.financial_statement_id == financial_statement_id
+    )))
+
+
+def missing_financial_statement_ids(table):
+    """Returns the set of financial_statement ids table has not been
+    populated with.
+
+    Financial statements with rows in table count as populated too, as
+    tables built before the populated statements were recorded have no
+    record of them.
+
+    """
+    financial_statement = FinancialStatement.__table__
+    header = Header.__table__
+    has_row = select([header.c.id]).select_from(
+        header.join(table, table.c.headerId == header.c.id)
+    ).where(
+        header.c.financial_statement_id == financial_statement.c.id
+    )
+    q = select([financial_statement.c.id]).where(and_(
+        ~exists(has_row), ~is_recorded(table, financial_statement.c.id)
+    ))
+    return set(fs_id for fs_id, in engine.execute(q))
+
+
+def record_statements(connection, table, financial_statement_ids):
+    """Record that table has been populated with financial_statement_ids."""
+    if not financial_statement_ids:
+        return
+    connection.execute(FeatureTableStatement.__table__.insert(), [
+        {'tablename': table.name, 'financial_statement_id': fs_id}
+        for fs_id in financial_statement_ids
+    ])
+    return
+
+
+class StatementIds(object):
+    """The financial_statement ids in [start_idx, end_idx) committed when it
+    was created, kept as a sorted array to use little memory.
+    """
+
+    def __init__(self, start_idx, end_idx):
+        financial_statement = FinancialStatement.__table__
+        q = select([financial_statement.c.id]).where(and_(
+            financial_statement.c.id >= start_idx,
+            financial_statement.c.id < end_idx
+        )).order_by(financial_statement.c.id)
+        self._ids = array('q', (fs_id for fs_id, in engine.execute(q)))
+
+    def __contains__(self, fs_id):
+        i = bisect.bisect_left(self._ids, fs_id)
+        return i < len(self._ids) and self._ids[i] == fs_id
+
+
+def record_remaining_statements(table, start_idx, end_idx, scanned_ids):
+    """Record the financial statements with ids in [start_idx, end_idx) and
+    in scanned_ids that are not recorded yet as populated in table.  These
+    are the financial statements without entries in their reporting period,
+    which populate_shard never sees.
+
+    scanned_ids must have been taken before populate_shard started reading
+    the entries, as a financial statement committed later may have been
+    passed over by the scan.
 
-    if instance:
-        return instance
+    """
+    financial_statement = FinancialStatement.__table__
+    q = select([financial_statement.c.id]).where(and_(
+        financial_statement.c.id >= start_idx,
+        financial_statement.c.id < end_idx,
+        ~is_recorded(table, financial_statement.c.id)
+    ))
+    with engine.begin() as connection:
+        ids = [fs_id for fs_id, in connection.execute(q)
+               if fs_id in scanned_ids]
+        record_statements(connection, table, ids)
+    return
 
+
+def header_values(fs_dict, financial_statement_id, consolidated):
+    """Returns the values of the Header row of a financial statement."""
     header_values = {
         'financial_statement_id': financial_statement_id,
         'language': find_language(fs_dict),
@@ -209,39 +355,128 @@ def make_header(fs_dict, financial_statement_id, consolidated, session):
     except ValueError:
         header_values['cmn_TypeOfAuditorAssistance'] = None
 
-    header = Header(**header_values)
-    session.add(header)
-    session.commit()
-    return header
+    return header_values
+
+
+def get_header_ids(connection, headers):
+    """Returns a dict from (financial_statement_id, consolidated) to the id
+    of the Header row, for each of the header values in headers.
+
+    Headers that do not exist yet are inserted with a single executemany.
+
+    """
+    header_table = Header.__table__
+    financial_statement_ids = set(h['financial_statement_id']
+                                  for h in headers)
+
+    def select_ids():
+        q = select([
+            header_table.c.financial_statement_id,
+            header_table.c.consolidated,
+            header_table.c.id
+        ]).where(
+            header_table.c.financial_statement_id.in_(financial_statement_ids)
+        )
+        return {(fs_id, bool(consolidated)): header_id
+                for fs_id, consolidated, header_id in connection.execute(q)}
+
+    header_ids = select_ids()
+    missing = {}
+    for h in headers:
+        key = (h['financial_statement_id'], bool(h['consolidated']))
+        if key not in header_ids:
+            missing[key] = h
+    if missing:
+        connection.execute(header_table.insert(), list(missing.values()))
+        header_ids = select_ids()
+    return header_ids
+
+
+def insert_rows(table, rows, financial_statement_ids=()):
+    """Insert rows into table.
+
+    rows is a list of pairs of header values and row values, as returned by
+    populate_row.  The Header rows are created as needed and the headerId of
+    each row is filled in, all in one transaction.  The financial statements
+    the rows were populated from are recorded in that transaction as well,
+    see record_statements.
+
+    """
+    with engine.begin() as connection:
+        if rows:
+            header_ids = get_header_ids(connection, [h for h, _ in rows])
+            values = []
+            for header, row_values in rows:
+                key = (header['financial_statement_id'],
+                       bool(header['consolidated']))
+                row_values['headerId'] = header_ids[key]
+                values.append(row_values)
+            connection.execute(table.insert(), values)
+        record_statements(connection, table, financial_statement_ids)
+    return
+
+
+def type_str_to_alchemy_type(s):
+    """Returns the sqlalchemy type of a TDF sqltype."""
+    if s == 'Double':
+        return Float()
+    if s[0:4] == 'Text':
+        size = 0
+        if len(s) > 4:
+            try:
+                size = int(s[5:-1])
+            except ValueError:
+                pass
+        if size:
+            return Text(size)
+        else:
+            return Text
+    if s == 'Integer':
+        return Integer()
+    if s == 'BigInteger':
+        return BigInteger()
+    if s == 'Datetime':
+        return DateTime()
+    if s == 'Boolean':
+        return Boolean()
+    raise ValueError('%s did not match any known type' % s)
+
+
+def create_parquet_sink(table_description, directory):
+    """Returns a ParquetSink for the table of table_description, replacing
+    any dataset previously written to directory.  Its rows have the Header
+    values of each financial statement followed by the table's columns; a
+    column of the table with the name of a Header column replaces it.
+    """
+    columns = [(column_description['name'],
+                type_str_to_alchemy_type(column_description['sqltype']))
+               for column_description in table_description['columns']]
+    names = set(name for name, _ in columns)
+    columns[:0] = [(column.name, column.type) for column in Header.__table__.c
+                   if column.name != 'id' and column.name not in names]
+    sink = ParquetSink(directory, table_description['tablename'], columns)
+    shutil.rmtree(sink.path, ignore_errors=True)
+    return sink
+
+
+def write_rows(output, rows, financial_statement_ids=()):
+    """Write rows, see populate_row, to a Table or a ParquetSink.
+
+    financial_statement_ids are the financial statements the rows were
+    populated from, including those that gave no rows, and are recorded for
+    a Table, see insert_rows.
+
+    """
+    if isinstance(output, ParquetSink):
+        output.write(rows)
+    else:
+        insert_rows(output, rows, financial_statement_ids)
+    return
 
 
 def create_table(table_description, drop_table=False):
     assert(isinstance(table_description, dict))
 
-    def type_str_to_alchemy_type(s):
-        if s == 'Double':
-            return Float()
-        if s[0:4] == 'Text':
-            size = 0
-            if len(s) > 4:
-                try:
-                    size = int(s[5:-1])
-                except ValueError:
-                    pass
-            if size:
-                return Text(size)
-            else:
-                return Text
-        if s == 'Integer':
-            return Integer()
-        if s == 'BigInteger':
-            return BigInteger()
-        if s == 'Datetime':
-            return DateTime()
-        if s == 'Boolean':
-            return Boolean()
-        raise ValueError('%s did not match any known type' % s)
-
     metadata = MetaData(bind=engine)
     tablename = table_description['tablename']
     columns = [Column('headerId', Integer,
@@ -257,81 +492,318 @@ def create_table(table_description, drop_table=False):
     if drop_table:
         t.drop(engine, checkfirst=True)
         t.create(engine, checkfirst=False)
+        recorded = FeatureTableStatement.__table__
+        engine.execute(recorded.delete().where(
+            recorded.c.tablename == tablename
+        ))
     return t
 
 
-def populate_row(table_description, fs_entries, fs_id,
-                 consolidated=False):
-    """
-    returns a dict with keys based on table_description and values
-    read from regnskab_tuples based on the method in table_description
-    """
-    global current_regnskabs_id
-    current_regnskabs_id = fs_id
-    fs_dict = dict([(k, list(v))
-                    for k, v in groupby(fs_entries,
-                                        lambda k: k.fieldName)])
-    session = Session()
-    header = make_header(fs_dict, fs_id, consolidated, session)
-    result = {'headerId': header.id}
-    session.close()
+# The columns computed from the entries of one regnskabs_fieldname with the
+# same dimensions.  builtin_columns are computed by the generic_ methods and
+# custom_columns by methods added with register_method; both are lists of
+# (column name, method, keyword arguments).
+FieldPlan = namedtuple('FieldPlan', ['regnskabs_fieldname', 'dimensions',
+                                     'builtin_columns', 'custom_columns'])
+
+BUILTIN_METHODS = (generic_number, generic_text, generic_date)
 
+
+def compile_table_description(table_description):
+    """Returns the execution plan of table_description, a list of
+    FieldPlans, see populate_row.
+
+    The methods are resolved once and the columns are grouped by
+    regnskabs_fieldname and dimensions, so the entries of each field are
+    looked up and filtered by dimensions once per financial statement rather
+    than once per column.
+
+    """
+    plan = OrderedDict()
     for column_description in table_description['columns']:
         methodname = column_description['method']['name']
         assert methodname in method_translation.keys()
+        method = method_translation[methodname]
         dimensions = column_description['dimensions']
         regnskabs_fieldname = column_description['regnskabs_fieldname']
-        column_name = column_description['name']
+        kwargs = {}
         if 'when_multiple' in column_description['method'].keys():
-            when_multiple = column_description['method']['when_multiple']
-            result[column_name] = method_translation[methodname](
-                fs_dict,
-                regnskabs_fieldname,
-                dimensions=dimensions,
-                when_multiple=when_multiple
+            kwargs['when_multiple'] = (
+                column_description['method']['when_multiple']
             )
+        key = (regnskabs_fieldname, json.dumps(dimensions))
+        if key not in plan:
+            plan[key] = FieldPlan(regnskabs_fieldname, dimensions, [], [])
+        if method in BUILTIN_METHODS:
+            columns = plan[key].builtin_columns
         else:
-            result[column_name] = method_translation[methodname](
-                fs_dict,
-                regnskabs_fieldname,
-                dimensions=dimensions,
-            )
+            columns = plan[key].custom_columns
+        method = profiling.timed_method(methodname, method)
+        columns.append((column_description['name'], method, kwargs))
+    return list(plan.values())
+
+
+def make_fs_dict(fs_entries):
+    """Returns a dict of fieldName to the entries with that fieldName."""
+    fs_dict = {}
+    for entry in fs_entries:
+        try:
+            fs_dict[entry.fieldName].append(entry)
+        except KeyError:
+            fs_dict[entry.fieldName] = [entry]
+    return fs_dict
 
+
+def populate_columns(plan, fs_dict):
+    """Returns a dict of the column values of the plan of a table, see
+    compile_table_description, for the financial statement in fs_dict.
+    """
+    result = {}
+    for field in plan:
+        fieldname = field.regnskabs_fieldname
+        if field.builtin_columns:
+            # the generic_ methods only look at the entries of fieldname, so
+            # they are given those already filtered by dimensions.
+            field_dict = {}
+            if fieldname in fs_dict:
+                values = fs_dict[fieldname]
+                if field.dimensions is not None:
+                    values = [t for t in values
+                              if t.dimensions == field.dimensions]
+                field_dict[fieldname] = values
+            for column_name, method, kwargs in field.builtin_columns:
+                result[column_name] = method(field_dict, fieldname, **kwargs)
+        for column_name, method, kwargs in field.custom_columns:
+            result[column_name] = method(fs_dict, fieldname,
+                                         dimensions=field.dimensions,
+                                         **kwargs)
     return result
 
 
-def populate_table(table_description, table):
-    assert(isinstance(table_description, dict))
-    assert(isinstance(table, Table))
-    print("Populating table %s" % table_description['tablename'])
-    cache = []
+def populate_row(table_description, fs_entries, fs_id,
+                 consolidated=False, plan=None):
+    """
+    returns a pair of the values of the Header row of the financial
+    statement and a dict with keys based on table_description and values
+    read from regnskab_tuples based on the method in table_description.
+
+    plan is the result of compile_table_description(table_description), pass
+    it when populating many rows.  The headerId of the row is filled in by
+    insert_rows.
+    """
+    global current_regnskabs_id
+    current_regnskabs_id = fs_id
+    if plan is None:
+        plan = compile_table_description(table_description)
+    fs_dict = make_fs_dict(fs_entries)
+    header = header_values(fs_dict, fs_id, consolidated)
+    return header, populate_columns(plan, fs_dict)
+
+
+ERASE = '\r\x1B[K'
+PROGRESS_TEMPLATE = "Processing financial statements %s/%s"
+
+# bytes of memory left for reading entries when a memory limit is below
+# what a transform process uses before reading any.
+MIN_ENTRY_MEMORY = 16 * 2**20
+
+
+def peak_rss(who=resource.RUSAGE_SELF):
+    """Returns the peak resident set size in bytes of this process, or with
+    resource.RUSAGE_CHILDREN of its largest terminated child process.
+    """
+    max_rss = resource.getrusage(who).ru_maxrss
+    if sys.platform == 'darwin':
+        return max_rss
+    return max_rss * 1024  # kilobytes on Linux.
+
+
+def entry_memory(memory_limit):
+    """Returns the bytes of memory a transform process may use for reading
+    entries to stay within memory_limit, or None if memory_limit is None.
+    """
+    if memory_limit is None:
+        return None
+    available = memory_limit - peak_rss()
+    if available < MIN_ENTRY_MEMORY:
+        print('Memory limit of %.0f MB is too low, this process already '
+              'uses %.0f MB.' % (memory_limit / 2**20, peak_rss() / 2**20),
+              file=sys.stderr)
+        available = MIN_ENTRY_MEMORY
+    return available
+
+
+def report_peak_rss(memory_limit=None):
+    """Print the peak memory of the transform, and a warning if it exceeded
+    memory_limit.
+    """
+    rss = peak_rss()
+    children_rss = peak_rss(resource.RUSAGE_CHILDREN)
+    if children_rss:
+        print('Peak memory %.0f MB, largest transform process %.0f MB.' %
+              (rss / 2**20, children_rss / 2**20))
+    else:
+        print('Peak memory %.0f MB.' % (rss / 2**20))
+    if memory_limit is not None and max(rss, children_rss) > memory_limit:
+        print('The memory limit of %.0f MB per process was exceeded.' %
+              (memory_limit / 2**20), file=sys.stderr)
+    return
+
+
+def populate_shard(table_descriptions, tables, start_idx=1, end_idx=None,
+                   progress=None, table_ids=None, memory_limit=None):
+    """Populate tables with the rows of the financial statements with ids in
+    [start_idx, end_idx).  The tables are sqlalchemy Tables or ParquetSinks.
+
+    All the tables are populated from a single pass over the financial
+    statements, each with its own buffer of rows to insert.  The financial
+    statements each Table is populated with are recorded, see
+    record_statements.
+
+    progress -- a multiprocessing.Value counting the financial statements
+                processed, or None to print the progress instead.
+    table_ids -- a list with, for each table, the set of financial_statement
+                 ids to populate it with, or None for all of them.
+    memory_limit -- the bytes of memory this process should stay within, or
+                    None to read a fixed number of entries at a time.
+
+    """
+    global current_regnskabs_id
+    caches = [[] for _ in tables]
+    processed = [[] for _ in tables]  # financial_statement ids per table.
     cache_sz = 2000
-    fs_iterator = financial_statement_iterator()
+    plans = [compile_table_description(t) for t in table_descriptions]
+    if table_ids is None:
+        table_ids = [None] * len(tables)
+    if end_idx is None:
+        end_idx = get_end_idx()
+    ids = None
+    if None not in table_ids:
+        ids = set().union(*table_ids)
+    # the statements visible before the scan, see record_remaining_statements.
+    visible_ids = None
+    if any(only_ids is None and not isinstance(table, ParquetSink)
+           for table, only_ids in zip(tables, table_ids)):
+        visible_ids = StatementIds(start_idx, end_idx)
+    fs_iterator = financial_statement_iterator(
+        end_idx=end_idx, start_idx=start_idx, ids=ids,
+        memory_limit=entry_memory(memory_limit)
+    )
 
-    ERASE = '\r\x1B[K'
-    progress_template = "Processing financial statements %s/%s"
     for i, end, fs_id, fs_entries in fs_iterator:
-        print(ERASE, end='', flush=True)
-        print(progress_template % (i, end), end='', flush=True)
+        if progress is None:
+            print(ERASE, end='', flush=True)
+            print(PROGRESS_TEMPLATE % (i, end), end='', flush=True)
+        else:
+            with progress.get_lock():
+                progress.value += 1
+        current_regnskabs_id = fs_id
+        for only_ids, fs_ids in zip(table_ids, processed):
+            if only_ids is None or fs_id in only_ids:
+                fs_ids.append(fs_id)
         partition = partition_consolidated(fs_entries)
-        fs_entries_cons, fs_entries_solo = partition
-        if len(fs_entries_cons):
-            row_values = populate_row(table_description, fs_entries_cons,
-                                      fs_id, consolidated=True)
-            if row_values:
-                cache.append(row_values)
-        if len(fs_entries_solo):
-            row_values = populate_row(table_description, fs_entries_solo,
-                                      fs_id, consolidated=False)
-            if row_values:
-                cache.append(row_values)
-        if len(cache) >= cache_sz:
-            engine.execute(table.insert(), cache)
-            cache = []
-    if len(cache):
-        engine.execute(table.insert(), cache)
-        cache = []
+        for consolidated, entries in zip((True, False), partition):
+            if not len(entries):
+                continue
+            fs_dict = make_fs_dict(entries)
+            header = header_values(fs_dict, fs_id, consolidated)
+            for plan, cache, only_ids in zip(plans, caches, table_ids):
+                if only_ids is not None and fs_id not in only_ids:
+                    continue
+                cache.append((header, populate_columns(plan, fs_dict)))
+        for table, cache, fs_ids in zip(tables, caches, processed):
+            if len(cache) >= cache_sz or len(fs_ids) >= cache_sz:
+                write_rows(table, cache, fs_ids)
+                cache.clear()
+                fs_ids.clear()
+    for table, cache, fs_ids, only_ids in zip(tables, caches, processed,
+                                              table_ids):
+        if len(cache) or len(fs_ids):
+            write_rows(table, cache, fs_ids)
+            cache.clear()
+            fs_ids.clear()
+        if isinstance(table, ParquetSink):
+            table.close()
+        else:
+            record_remaining_statements(
+                table, start_idx, end_idx,
+                visible_ids if only_ids is None else only_ids
+            )
+    return
+
+
+def _populate_shard_process(*args):
+    # the connections of the parent must not be shared with it.
+    engine.dispose()
+    with profiling.profiled('transform-shard'):
+        populate_shard(*args)
+    return
+
+
+def populate_tables(table_descriptions, tables, process_count=1,
+                    table_ids=None, memory_limit=None):
+    """Populate tables from all financial statements, in a single pass.
+
+    table_ids is a list with, for each table, the set of financial_statement
+    ids to populate it with, or None for all of them.
+
+    With a process_count above 1 the financial_statement ids are split in
+    that many consecutive ranges, each populated by its own process.  The
+    ranges are disjoint, so the processes never create the same Header row.
+
+    memory_limit is the bytes of memory all processes together should stay
+    within, or None.  The peak memory is printed when done.
+
+    """
+    for table_description, table in zip(table_descriptions, tables):
+        assert isinstance(table_description, dict)
+        assert isinstance(table, (Table, ParquetSink))
+    print("Populating tables %s" % ', '.join(t['tablename']
+                                             for t in table_descriptions))
+    if process_count == 1:
+        populate_shard(table_descriptions, tables, table_ids=table_ids,
+                       memory_limit=memory_limit)
+        print(flush=True)
+        report_peak_rss(memory_limit)
+        return
+
+    end_idx = get_end_idx()
+    total_rows = get_number_of_rows()
+    if table_ids is not None and None not in table_ids:
+        total_rows = len(set().union(*table_ids))
+    shard_size = -(-(end_idx - 1) // process_count)  # round up.
+    progress = multiprocessing.Value('l', 0)
+    process_memory_limit = None
+    if memory_limit is not None:
+        process_memory_limit = memory_limit // process_count
+    engine.dispose()
+    workers = [Process(target=_populate_shard_process,
+                       args=(table_descriptions, tables, start,
+                             min(start + shard_size, end_idx), progress,
+                             table_ids, process_memory_limit))
+               for start in range(1, end_idx, shard_size)]
+    for worker in workers:
+        worker.start()
+    while any(worker.is_alive() for worker in workers):
+        print(ERASE, end='', flush=True)
+        print(PROGRESS_TEMPLATE % (progress.value, total_rows), end='',
+              flush=True)
+        for worker in workers:
+            worker.join(timeout=1)
+            if worker.is_alive():
+                break
     print(flush=True)
+    failed = [worker for worker in workers if worker.exitcode != 0]
+    if failed:
+        raise RuntimeError('%s of %s transform processes failed.' %
+                           (len(failed), len(workers)))
+    report_peak_rss(process_memory_limit)
+    return
+
+
+def populate_table(table_description, table, process_count=1):
+    """Populate table from all financial statements, see populate_tables."""
+    populate_tables([table_description], [table], process_count)
     return
 
 
@@ -340,8 +812,9 @@ def find_regnskabs_id():
 
 
 def find_currency(fs_dict):
-    """Check balance statements of regnskab to find the currency used.  We assume
-    the same currency is used for everything, though this is not a requirement.
+    """Check balance statements of regnskab to find the currency used.  We
+    assume the same currency is used for everything, though this is not a
+    requirement.
 
     regnskab_dict -- dict of fieldname to corresponding tuples for regnskab.
 
@@ -391,7 +864,8 @@ def find_balancedato(fs_dict):
 
 
 def get_most_precise(regnskab_tuples):
-    """ Returns the 'best' value for a given entry in a financial statement """
+    """ Returns the 'best' value for a given entry in a financial statement,
+    the numericValue of numeric facts and the fieldValue of others. """
 
     def order_key(t):
         """
@@ -399,18 +873,27 @@ def get_most_precise(regnskab_tuples):
         precision, startDate, endDate, unitId.
         """
         dec = -1000
-        if (t.decimals is not None and len(t.decimals) > 0 and
-                t.decimals.lower() != 'inf'):
-            dec = float(t.decimals)
         is_dec_inf = False
-        if t.decimals is not None and t.decimals.lower() == 'inf':
+        decimals = t.decimalsValue
+        if decimals is None and t.decimals:
+            # entries inserted before decimalsValue was parsed at ingest.
+            decimals = parse_decimals(t.decimals)
+            if decimals is None:
+                dec = float(t.decimals)
+        if decimals == DECIMALS_INF:
             is_dec_inf = True
+        elif decimals is not None:
+            dec = decimals
 
         return (t.startDate, t.endDate, is_dec_inf,
                 dec, t.fieldValue)
 
     regnskab_tuples.sort(key=order_key, reverse=True)
-    return regnskab_tuples[0].fieldValue
+    most_precise = regnskab_tuples[0]
+    if most_precise.numericValue is not None:
+        return most_precise.numericValue
+    # text facts, and entries not backfilled by migrate yet.
+    return most_precise.fieldValue
 
 
 def fieldname_to_colname(fieldname):
@@ -426,16 +909,61 @@ def register_method(name, func):
     method_translation[name] = func
 
 
-def main(table_descriptions_file):
-    Base.metadata.create_all(engine)
-    tables = dict()
+def main(table_descriptions_files, process_count=1, incremental=False,
+         parquet_dir=None, memory_limit=None):
+    """Create and populate the tables of one or more table definitions
+    files, all from a single pass over the financial statements.
+
+    If incremental is True, tables that were built from the same definition
+    before are kept and only populated with the financial statements they
+    have not been populated with yet.  Tables whose definition changed are
+    rebuilt.
 
-    with open(table_descriptions_file) as fp:
-        table_descriptions = json.load(fp)
+    If parquet_dir is given, the tables are written as Parquet datasets in
+    that directory instead of to the database, see ParquetSink.  This cannot
+    be combined with incremental.
 
+    memory_limit is the bytes of memory the transform should stay within,
+    see populate_tables.
+
+    """
+    if parquet_dir is not None and incremental:
+        raise ValueError('Parquet output cannot be built incrementally.')
+    if isinstance(table_descriptions_files, str):
+        table_descriptions_files = [table_descriptions_files]
+    upgrade_schema(Base.metadata)
+    ensure_migrated()
+
+    table_descriptions = []
+    for table_descriptions_file in table_descriptions_files:
+        with open(table_descriptions_file) as fp:
+            table_descriptions.extend(json.load(fp))
+
+    if parquet_dir is not None:
+        sinks = [create_parquet_sink(t, parquet_dir)
+                 for t in table_descriptions]
+        populate_tables(table_descriptions, sinks, process_count,
+                        memory_limit=memory_limit)
+        return
+
+    tables = []
+    table_ids = []
     for t in table_descriptions:
-        table = create_table(t, drop_table=True)
-        populate_table(t, table)
-        tables[t['tablename']] = table
+        table = create_table(t)
+        if incremental and is_up_to_date(t, table):
+            ids = missing_financial_statement_ids(table)
+            print('Table %s is up to date, adding %s financial statements.' %
+                  (t['tablename'], len(ids)))
+        else:
+            if incremental:
+                print('Table %s changed, rebuilding it.' % t['tablename'])
+            table = create_table(t, drop_table=True)
+            ids = None
+        tables.append(table)
+        table_ids.append(ids)
+
+    populate_tables(table_descriptions, tables, process_count, table_ids,
+                    memory_limit)
+    save_definitions(table_descriptions)
 
     return
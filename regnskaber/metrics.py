@@ -0,0 +1,301 @@
+""" Counters and latency histograms for the stages of the fetch.
+
+Every process records into its own registry and periodically sends what it
+recorded to a collector thread in the process that called setup_metrics.  The
+collector aggregates everything and writes a report every interval seconds,
+either as a JSON line or as a Prometheus textfile.
+
+Recording is a no-op until setup_metrics has been called, and setup_metrics
+must be called before forking the processes to collect from.
+"""
+import json
+import multiprocessing
+import os
+import threading
+import time
+
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from queue import Empty
+
+# upper bounds in seconds of the latency histogram buckets.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+           30.0, 60.0, float('inf'))
+
+FLUSH_INTERVAL = 5  # seconds between sending recordings to the collector.
+
+_recorder = None
+
+
+class Registry:
+    """Counters and latency histograms, safe to use from several threads."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = Counter()
+        self.histograms = {}  # name -> [bucket counts, sum of seconds].
+
+    def increment(self, name, n=1):
+        with self._lock:
+            self.counters[name] += n
+
+    def observe(self, name, seconds):
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = [[0] * len(BUCKETS), 0.0]
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    histogram[0][i] += 1
+                    break
+            histogram[1] += seconds
+
+    def merge(self, counters, histograms):
+        with self._lock:
+            self.counters.update(counters)
+            for name, (buckets, total) in histograms.items():
+                histogram = self.histograms.get(name)
+                if histogram is None:
+                    histogram = self.histograms[name] = [[0] * len(BUCKETS),
+                                                         0.0]
+                for i, count in enumerate(buckets):
+                    histogram[0][i] += count
+                histogram[1] += total
+
+    def take(self):
+        """Returns and resets the recorded counters and histograms."""
+        with self._lock:
+            counters, self.counters = dict(self.counters), Counter()
+            histograms, self.histograms = self.histograms, {}
+        return counters, histograms
+
+
+class Recorder:
+    def __init__(self, reports):
+        self.reports = reports
+        self.registry = Registry()
+        self.pid = os.getpid()
+        self.last_flush = time.monotonic()
+
+    def maybe_flush(self):
+        if time.monotonic() - self.last_flush >= FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        self.last_flush = time.monotonic()
+        counters, histograms = self.registry.take()
+        if counters or histograms:
+            self.reports.put((counters, histograms))
+
+
+def _get_recorder():
+    recorder = _recorder
+    if recorder is not None and recorder.pid != os.getpid():
+        # forked: start from an empty registry.
+        recorder.registry = Registry()
+        recorder.pid = os.getpid()
+    return recorder
+
+
+def increment(name, n=1):
+    recorder = _get_recorder()
+    if recorder is None:
+        return
+    recorder.registry.increment(name, n)
+    recorder.maybe_flush()
+
+
+def observe(name, seconds):
+    recorder = _get_recorder()
+    if recorder is None:
+        return
+    recorder.registry.observe(name, seconds)
+    recorder.maybe_flush()
+
+
+@contextmanager
+def timed(name):
+    """Observe the time spent in the block as the latency of stage name."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start)
+
+
+def timed_iter(iterable, name):
+    """Iterate over iterable, observing the time spent waiting for each
+    element as the latency of stage name.
+    """
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            element = next(iterator)
+        except StopIteration:
+            return
+        observe(name, time.perf_counter() - start)
+        yield element
+
+
+def flush():
+    """Send what this process recorded to the collector.  Call before a
+    process exits.
+    """
+    recorder = _get_recorder()
+    if recorder is not None:
+        recorder.flush()
+
+
+def quantile_ms(buckets, q):
+    """Returns the upper bound in milliseconds of the bucket containing the q
+    quantile, or None if it is in the last, unbounded, bucket.
+    """
+    total = sum(buckets)
+    seen = 0
+    for bound, count in zip(BUCKETS[:-1], buckets):
+        seen += count
+        if seen >= q * total:
+            return 1000 * bound
+    return None
+
+
+class Collector(threading.Thread):
+    """Aggregates the recordings of all processes and writes a report to
+    path every interval seconds.
+
+    fmt -- 'jsonl' appends a JSON line per report, 'prometheus' replaces path
+           with a Prometheus textfile.
+    gauges -- a callable returning a dict of current values to report, e.g.
+              queue sizes.
+
+    """
+
+    def __init__(self, reports, path, fmt='jsonl', interval=60,
+                 gauges=None, prefix='regnskaber_fetch'):
+        super().__init__(daemon=True)
+        if fmt not in ('jsonl', 'prometheus'):
+            raise ValueError('Unknown metrics format %s' % fmt)
+        self.reports = reports
+        self.path = path
+        self.fmt = fmt
+        self.interval = interval
+        self.gauges = gauges
+        self.prefix = prefix
+        self.totals = Registry()
+        self.started = time.monotonic()
+        self._last_counters = {}
+        self._last_report = self.started
+        self._stop_event = threading.Event()
+
+    def run(self):
+        next_report = time.monotonic() + self.interval
+        while not self._stop_event.is_set():
+            self._drain(timeout=max(0.0, next_report - time.monotonic()))
+            if time.monotonic() >= next_report:
+                self.write_report()
+                next_report = time.monotonic() + self.interval
+
+    def _drain(self, timeout=0.0):
+        try:
+            counters, histograms = self.reports.get(timeout=min(timeout, 1.0))
+        except Empty:
+            return
+        self.totals.merge(counters, histograms)
+        while True:
+            try:
+                counters, histograms = self.reports.get_nowait()
+            except Empty:
+                return
+            self.totals.merge(counters, histograms)
+
+    def stop(self):
+        """Collect the last recordings, write a final report and stop."""
+        self._stop_event.set()
+        self.join()
+        flush()
+        time.sleep(0.1)  # let the queue feeder threads deliver.
+        self._drain()
+        self.write_report()
+
+    def snapshot(self):
+        now = time.monotonic()
+        counters = dict(self.totals.counters)
+        elapsed = now - self._last_report
+        rates = {name: (value - self._last_counters.get(name, 0)) / elapsed
+                 for name, value in counters.items() if elapsed > 0}
+        self._last_counters = counters
+        self._last_report = now
+        latency = {}
+        for name, (buckets, total) in self.totals.histograms.items():
+            count = sum(buckets)
+            latency[name] = {
+                'count': count,
+                'mean_ms': 1000 * total / count if count else None,
+                'p50_ms': quantile_ms(buckets, 0.5),
+                'p95_ms': quantile_ms(buckets, 0.95),
+            }
+        return {
+            'time': datetime.now().isoformat(),
+            'elapsed': now - self.started,
+            'counters': counters,
+            'rates': rates,
+            'latency': latency,
+            'gauges': self.gauges() if self.gauges is not None else {},
+        }
+
+    def write_report(self):
+        if self.fmt == 'jsonl':
+            with open(self.path, 'a') as fp:
+                print(json.dumps(self.snapshot()), file=fp, flush=True)
+            return
+        lines = []
+        for name, value in sorted(self.totals.counters.items()):
+            metric = '%s_%s_total' % (self.prefix, name)
+            lines.append('# TYPE %s counter' % metric)
+            lines.append('%s %s' % (metric, value))
+        gauges = self.gauges() if self.gauges is not None else {}
+        for name, value in sorted(gauges.items()):
+            metric = '%s_%s' % (self.prefix, name)
+            lines.append('# TYPE %s gauge' % metric)
+            lines.append('%s %s' % (metric, value))
+        metric = '%s_stage_seconds' % self.prefix
+        lines.append('# TYPE %s histogram' % metric)
+        for name, (buckets, total) in sorted(self.totals.histograms.items()):
+            cumulative = 0
+            for bound, count in zip(BUCKETS, buckets):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('%s_bucket{stage="%s",le="%s"} %s' % (
+                    metric, name, le, cumulative))
+            lines.append('%s_sum{stage="%s"} %s' % (metric, name, total))
+            lines.append('%s_count{stage="%s"} %s' % (metric, name,
+                                                      cumulative))
+        # replace atomically so a scraper never reads half a file.
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as fp:
+            print('\n'.join(lines), file=fp)
+        os.replace(tmp_path, self.path)
+
+
+def setup_metrics(path, fmt='jsonl', interval=60, gauges=None):
+    """Start collecting metrics from this process and its future children.
+
+    Returns the Collector; call its stop method when done.
+
+    """
+    global _recorder
+    reports = multiprocessing.Queue()
+    _recorder = Recorder(reports)
+    collector = Collector(reports, path, fmt=fmt, interval=interval,
+                          gauges=gauges)
+    collector.start()
+    return collector
+
+
+def teardown_metrics(collector):
+    """Stop collector and stop recording."""
+    global _recorder
+    collector.stop()
+    _recorder = None
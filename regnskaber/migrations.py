@@ -0,0 +1,336 @@
+""" Schema changes of existing databases.
+
+create_all only creates missing tables, so columns added to the models after
+a database was created are added here.
+"""
+from sqlalchemy import and_, bindparam, column, func, inspect, select, text
+
+from itertools import groupby
+from operator import itemgetter
+
+from . import engine
+from .lookups import ENTRY_LOOKUPS, get_lookup_cache
+from .models import Base, FinancialStatement, FinancialStatementEntry
+from .shared import (STATEMENT_WINDOW_SIZE, entry_row_columns, entry_row_from,
+                     parse_decimals, parse_numeric_value,
+                     reporting_period_flags)
+
+MIGRATE_BATCH_SIZE = 10000  # entries per transaction.
+
+
+def table_columns(table_name):
+    """Returns the names of the columns of table_name in the database."""
+    with engine.connect() as connection:
+        return set(c['name']
+                   for c in inspect(connection).get_columns(table_name))
+
+
+def add_missing_columns(table):
+    """Add the columns of the sqlalchemy table that are missing in the
+    database, e.g. after upgrading regnskaber.  The added columns are NULL in
+    existing rows.
+
+    Returns the names of the added columns.
+
+    """
+    existing = table_columns(table.name)
+    preparer = engine.dialect.identifier_preparer
+    added = []
+    for table_column in table.columns:
+        if table_column.name in existing:
+            continue
+        engine.execute('ALTER TABLE %s ADD COLUMN %s %s' % (
+            preparer.format_table(table),
+            preparer.format_column(table_column),
+            table_column.type.compile(dialect=engine.dialect)
+        ))
+        added.append(table_column.name)
+    return added
+
+
+def upgrade_schema(metadata):
+    """Create the missing tables and columns of metadata."""
+    metadata.create_all(engine)
+    for table in metadata.sorted_tables:
+        added = add_missing_columns(table)
+        if added:
+            print('Added columns %s to %s.' % (', '.join(added), table.name))
+    return
+
+
+def legacy_entry_columns():
+    """Returns the string columns of financial_statement_entry that were
+    replaced by ids of lookup tables, and are still in the database.
+    """
+    existing = table_columns(FinancialStatementEntry.__tablename__)
+    return [value_name for value_name, _, _ in ENTRY_LOOKUPS
+            if value_name in existing]
+
+
+def ensure_migrated():
+    """Raise an error if the database has not been migrated to lookup
+    tables yet.
+    """
+    if legacy_entry_columns():
+        raise RuntimeError('The database has entries without lookup ids. '
+                           'Run: python -m regnskaber migrate')
+    return
+
+
+def migrate_entry_lookups(batch_size=MIGRATE_BATCH_SIZE):
+    """Move the fieldName, dimensions and unitIdXbrl strings of existing
+    entries to the lookup tables and drop the string columns.
+
+    The entries are updated batch_size at a time, each batch in its own
+    transaction, so an interrupted migration can be resumed.
+
+    """
+    legacy = legacy_entry_columns()
+    if not legacy:
+        return
+
+    entry_table = FinancialStatementEntry.__table__
+    lookups = [(value_name, id_name, get_lookup_cache(model))
+               for value_name, id_name, model in ENTRY_LOOKUPS
+               if value_name in legacy]
+    # the legacy columns are not in the model, so they are referred to by
+    # name.
+    q = select(
+        [entry_table.c.id] + [column(value_name) for value_name in legacy]
+    ).select_from(entry_table)
+    update = entry_table.update().where(
+        entry_table.c.id == bindparam('entry_id')
+    ).values(**{id_name: bindparam('new_' + id_name)
+                for _, id_name, _ in lookups})
+
+    max_id = engine.execute(select([func.max(entry_table.c.id)])).scalar()
+    for start in range(1, (max_id or 0) + 1, batch_size):
+        print('\r\x1B[K' + 'Migrating entries %s/%s' % (start, max_id),
+              end='', flush=True)
+        rows = engine.execute(q.where(and_(
+            entry_table.c.id >= start,
+            entry_table.c.id < start + batch_size,
+            entry_table.c.conceptId.is_(None)
+        ))).fetchall()
+        if not rows:
+            continue
+        values = []
+        for value_name, id_name, lookup_cache in lookups:
+            ids = lookup_cache.get_ids(row[value_name] for row in rows)
+            values.append((value_name, id_name, ids))
+        updates = []
+        for row in rows:
+            update_values = {'entry_id': row['id']}
+            for value_name, id_name, ids in values:
+                value = row[value_name]
+                update_values['new_' + id_name] = (
+                    None if value is None else ids[value]
+                )
+            updates.append(update_values)
+        with engine.begin() as connection:
+            connection.execute(update, updates)
+    print(flush=True)
+
+    preparer = engine.dialect.identifier_preparer
+    for value_name in legacy:
+        print('Dropping column %s of %s.' % (value_name, entry_table.name))
+        engine.execute('ALTER TABLE %s DROP COLUMN %s' % (
+            preparer.format_table(entry_table),
+            preparer.quote(value_name)
+        ))
+    return
+
+
+def backfill_numeric_values(batch_size=MIGRATE_BATCH_SIZE):
+    """Set the numericValue and decimalsValue of existing entries, which are
+    parsed at ingest for new financial statements.
+
+    Only entries with decimals and no decimalsValue are read, batch_size
+    entries per transaction, so an interrupted backfill can be resumed.
+
+    """
+    entry_table = FinancialStatementEntry.__table__
+    q = select([entry_table.c.id, entry_table.c.fieldValue,
+                entry_table.c.decimals])
+    update = entry_table.update().where(
+        entry_table.c.id == bindparam('entry_id')
+    ).values(numericValue=bindparam('numeric_value'),
+             decimalsValue=bindparam('decimals_value'))
+
+    max_id = engine.execute(select([func.max(entry_table.c.id)])).scalar()
+    for start in range(1, (max_id or 0) + 1, batch_size):
+        print('\r\x1B[K' + 'Parsing values of entries %s/%s' % (
+            start, max_id), end='', flush=True)
+        rows = engine.execute(q.where(and_(
+            entry_table.c.id >= start,
+            entry_table.c.id < start + batch_size,
+            entry_table.c.decimals.isnot(None),
+            entry_table.c.decimalsValue.is_(None)
+        ))).fetchall()
+        updates = []
+        for entry_id, fieldValue, decimals in rows:
+            decimals_value = parse_decimals(decimals)
+            numeric_value = parse_numeric_value(fieldValue, decimals)
+            if decimals_value is None and numeric_value is None:
+                continue
+            updates.append({'entry_id': entry_id,
+                            'numeric_value': numeric_value,
+                            'decimals_value': decimals_value})
+        if not updates:
+            continue
+        with engine.begin() as connection:
+            connection.execute(update, updates)
+    print(flush=True)
+    return
+
+
+def backfill_reporting_period(window_size=STATEMENT_WINDOW_SIZE):
+    """Set the reporting period of existing financial statements and the
+    inReportingPeriod flag of their entries, which are computed at ingest
+    for new financial statements.
+
+    Only financial statements with entries that are not flagged are read,
+    window_size financial statements per transaction, so an interrupted
+    backfill can be resumed.
+
+    """
+    entry_table = FinancialStatementEntry.__table__
+    fs_table = FinancialStatement.__table__
+    columns = dict((c.name, c) for c in entry_row_columns())
+    q = select([
+        columns['id'], columns['financial_statement_id'],
+        columns['fieldName'], columns['fieldValue'], columns['startDate'],
+        columns['endDate']
+    ]).select_from(entry_row_from())
+    unflagged = select([entry_table.c.financial_statement_id]).where(
+        entry_table.c.inReportingPeriod.is_(None)
+    )
+    update_entry = entry_table.update().where(
+        entry_table.c.id == bindparam('entry_id')
+    ).values(inReportingPeriod=bindparam('flag'))
+    update_statement = fs_table.update().where(
+        fs_table.c.id == bindparam('fs_id')
+    ).values(reportingPeriodStartDate=bindparam('start_date'),
+             reportingPeriodEndDate=bindparam('end_date'))
+
+    financial_statement_id = entry_table.c.financial_statement_id
+    max_id = engine.execute(select([func.max(fs_table.c.id)])).scalar()
+    for start in range(1, (max_id or 0) + 1, window_size):
+        print('\r\x1B[K' + 'Flagging financial statements %s/%s' % (
+            start, max_id), end='', flush=True)
+        window = and_(financial_statement_id >= start,
+                      financial_statement_id < start + window_size)
+        rows = engine.execute(q.where(and_(
+            window, financial_statement_id.in_(unflagged.where(window))
+        )).order_by(financial_statement_id, entry_table.c.id)).fetchall()
+        entry_updates = []
+        statement_updates = []
+        for fs_id, entries in groupby(rows, itemgetter(1)):
+            entries = list(entries)
+            (start_date, end_date), flags = reporting_period_flags(
+                [(row[2], row[3], row[4], row[5]) for row in entries]
+            )
+            if start_date is None:
+                continue
+            statement_updates.append({'fs_id': fs_id,
+                                      'start_date': start_date,
+                                      'end_date': end_date})
+            entry_updates.extend({'entry_id': row[0], 'flag': flag}
+                                 for row, flag in zip(entries, flags)
+                                 if flag is not None)
+        if not statement_updates:
+            continue
+        with engine.begin() as connection:
+            connection.execute(update_statement, statement_updates)
+            if entry_updates:
+                connection.execute(update_entry, entry_updates)
+    print(flush=True)
+    return
+
+
+def existing_indexes(table_name):
+    """Returns a dict from index name to the list of its columns, of the
+    indexes of table_name in the database.
+    """
+    with engine.connect() as connection:
+        return {index['name']: index['column_names']
+                for index in inspect(connection).get_indexes(table_name)}
+
+
+def ensure_indexes(metadata):
+    """Create the indexes of metadata missing in the database, and recreate
+    those whose columns differ.  Returns the names of the created indexes.
+    """
+    created = []
+    for table in metadata.sorted_tables:
+        existing = existing_indexes(table.name)
+        for index in sorted(table.indexes, key=lambda i: i.name):
+            columns = [c.name for c in index.columns]
+            if existing.get(index.name) == columns:
+                continue
+            if index.name in existing:
+                print('Index %s has columns %s instead of %s, recreating it.'
+                      % (index.name, existing[index.name], columns))
+                index.drop(engine)
+            print('Creating index %s on %s(%s).' % (
+                index.name, table.name, ', '.join(columns)), flush=True)
+            index.create(engine)
+            created.append(index.name)
+    return created
+
+
+def index_size(table_name, index_name):
+    """Returns the size in bytes of an index, or None if the database does
+    not tell, e.g. when the user may not read the statistics.
+    """
+    if engine.name == 'postgresql':
+        q = text('SELECT pg_relation_size(quote_ident(:index_name)::regclass)')
+    elif engine.name == 'mysql':
+        # needs the SELECT privilege on the mysql schema.
+        q = text("SELECT stat_value * @@innodb_page_size "
+                 "FROM mysql.innodb_index_stats "
+                 "WHERE database_name = DATABASE() AND "
+                 "table_name = :table_name AND index_name = :index_name AND "
+                 "stat_name = 'size'")
+    elif engine.name == 'sqlite':
+        # needs SQLite compiled with the dbstat virtual table.
+        q = text('SELECT SUM(pgsize) FROM dbstat WHERE name = :index_name')
+    else:
+        return None
+    try:
+        return engine.execute(q, table_name=table_name,
+                              index_name=index_name).scalar()
+    except Exception:
+        return None
+
+
+def report_indexes(metadata):
+    """Print the indexes of metadata, whether they exist and their size."""
+    print('%-45s %-10s %12s' % ('index', 'status', 'size (MB)'))
+    for table in metadata.sorted_tables:
+        existing = existing_indexes(table.name)
+        for index in sorted(table.indexes, key=lambda i: i.name):
+            if index.name not in existing:
+                print('%-45s %-10s %12s' % (index.name, 'missing', ''))
+                continue
+            size = index_size(table.name, index.name)
+            size = '' if size is None else '%.1f' % (size / 2**20)
+            print('%-45s %-10s %12s' % (index.name, 'ok', size))
+    return
+
+
+def migrate(batch_size=MIGRATE_BATCH_SIZE):
+    """Bring a database created by an earlier version up to date: add the
+    missing tables and columns, move entries to the lookup tables, parse
+    the values of the entries, create the indexes, flag the entries in the
+    reporting period and report the sizes of the indexes.
+    """
+    upgrade_schema(Base.metadata)
+    migrate_entry_lookups(batch_size)
+    backfill_numeric_values(batch_size)
+    # the backfill reads the entries of ranges of financial statements,
+    # which needs the index on financial_statement_id.
+    ensure_indexes(Base.metadata)
+    backfill_reporting_period()
+    report_indexes(Base.metadata)
+    return
@@ -1,11 +1,14 @@
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import (Column, Integer, String, DateTime, BigInteger, Text,
-                        ForeignKey, Sequence)
+                        ForeignKey, Sequence, Float, Index, Boolean)
 from sqlalchemy.orm import relationship
 
 
 Base = declarative_base()
 
+# decimalsValue of entries with decimals="INF", i.e. exact values.
+DECIMALS_INF = 2**31 - 1
+
 
 class FinancialStatement(Base):
 
@@ -16,6 +19,9 @@ class FinancialStatement(Base):
     indlaesningsTidspunkt = Column(DateTime)
     cvrnummer = Column(BigInteger)
     erst_id = Column(String(length=100), index=True, unique=True)
+    # from gsd:ReportingPeriodStartDate and EndDate, computed at ingest.
+    reportingPeriodStartDate = Column(DateTime)
+    reportingPeriodEndDate = Column(DateTime)
 
     financial_statement_entries = relationship(
         'FinancialStatementEntry',
@@ -23,7 +29,43 @@ class FinancialStatement(Base):
         order_by='FinancialStatementEntry.id',
     )
 
-    __table_args__ = {'mysql_row_format': 'COMPRESSED'}
+    __table_args__ = (
+        # the filings of a company in order of publication.
+        Index('ix_financial_statement_cvrnummer_published', 'cvrnummer',
+              'offentliggoerelsesTidspunkt'),
+        {'mysql_row_format': 'COMPRESSED'},
+    )
+
+
+class Concept(Base):
+    """The fieldNames of the entries, e.g. fsa:ProfitLoss."""
+
+    __tablename__ = 'concept'
+
+    id = Column(Integer, Sequence('concept_id_sequence'), primary_key=True)
+    hash = Column(String(length=40), unique=True)  # sha1 of value.
+    value = Column(String(length=1000))
+
+
+class DimensionSet(Base):
+    """The dimensions of the entries."""
+
+    __tablename__ = 'dimension_set'
+
+    id = Column(Integer, Sequence('dimension_set_id_sequence'),
+                primary_key=True)
+    hash = Column(String(length=40), unique=True)  # sha1 of value.
+    value = Column(String(length=10000))
+
+
+class Unit(Base):
+    """The unitIdXbrls of the entries, e.g. iso4217:DKK."""
+
+    __tablename__ = 'unit'
+
+    id = Column(Integer, Sequence('unit_id_sequence'), primary_key=True)
+    hash = Column(String(length=40), unique=True)  # sha1 of value.
+    value = Column(String(length=100))
 
 
 class FinancialStatementEntry(Base):
@@ -33,19 +75,59 @@ class FinancialStatementEntry(Base):
     id = Column(Integer, Sequence('id_sequence'), primary_key=True)
     financial_statement_id = Column(Integer,
                                     ForeignKey('financial_statement.id'))
-    fieldName = Column(String(length=1000))
+    conceptId = Column(Integer, ForeignKey('concept.id'))
     fieldValue = Column(Text(length=2**32-1, convert_unicode=True))
     decimals = Column(String(length=20))
     cvrnummer = Column(BigInteger)
     startDate = Column(DateTime)
     endDate = Column(DateTime)
-    dimensions = Column(String(length=10000))
-    unitIdXbrl = Column(String(length=100))
+    dimensionSetId = Column(Integer, ForeignKey('dimension_set.id'))
+    unitId = Column(Integer, ForeignKey('unit.id'))
     koncern = Column(Integer)
+    # fieldValue and decimals parsed at ingest, NULL for non-numeric facts.
+    numericValue = Column(Float(precision=53))
+    decimalsValue = Column(Integer)
+    # whether the entry is in the reporting period of its financial
+    # statement, NULL if that is unknown.
+    inReportingPeriod = Column(Boolean)
 
     financial_statement = relationship(
         'FinancialStatement',
         back_populates='financial_statement_entries',
     )
 
-    __table_args__ = {'mysql_row_format': 'COMPRESSED'}
+    __table_args__ = (
+        # the entries of a range of financial statements, in the order read
+        # by financial_statement_iterator.
+        Index('ix_entry_financial_statement_id', 'financial_statement_id',
+              'id'),
+        # the values of a concept for a company.
+        Index('ix_entry_cvrnummer_concept', 'cvrnummer', 'conceptId'),
+        Index('ix_entry_concept', 'conceptId'),
+        {'mysql_row_format': 'COMPRESSED'},
+    )
+
+
+class FetchCheckpoint(Base):
+    """Everything published before offentliggoerelsesTidspunkt has been
+    handled by a fetch.
+    """
+
+    __tablename__ = 'fetch_checkpoint'
+
+    name = Column(String(length=100), primary_key=True)
+    offentliggoerelsesTidspunkt = Column(DateTime)
+    indlaesningsTidspunkt = Column(DateTime)
+    updated = Column(DateTime)
+
+
+class FetchRetry(Base):
+    """A financial statement that failed to download, parse or insert, to be
+    retried by the next incremental fetch.
+    """
+
+    __tablename__ = 'fetch_retry'
+
+    erst_id = Column(String(length=100), primary_key=True)
+    message = Column(Text)  # the queue message as JSON.
+    failed = Column(DateTime)
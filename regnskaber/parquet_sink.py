@@ -0,0 +1,156 @@
+""" Writes feature tables as Parquet datasets instead of SQL tables.
+
+This requires pyarrow, which is an optional dependency:
+
+    pip install regnskaber[parquet]
+"""
+import datetime
+import os
+
+from sqlalchemy import BigInteger, Boolean, DateTime, Float, Integer
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+ROW_GROUP_SIZE = 50000  # rows buffered per partition before writing.
+
+DEFAULT_PARTITION = '__HIVE_DEFAULT_PARTITION__'  # rows without a year.
+
+
+def arrow_type(alchemy_type):
+    """Returns the arrow type of a column of the sqlalchemy type."""
+    if isinstance(alchemy_type, Boolean):
+        return pyarrow.bool_()
+    if isinstance(alchemy_type, (Integer, BigInteger)):
+        return pyarrow.int64()
+    if isinstance(alchemy_type, Float):
+        return pyarrow.float64()
+    if isinstance(alchemy_type, DateTime):
+        return pyarrow.timestamp('us')
+    return pyarrow.string()
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        pass
+    try:
+        return int(float(value))
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+
+def _to_timestamp(value):
+    if isinstance(value, datetime.datetime):
+        return value
+    if isinstance(value, datetime.date):
+        return datetime.datetime(value.year, value.month, value.day)
+    return None
+
+
+def _to_string(value):
+    if value is None:
+        return None
+    return str(value)
+
+
+def converter(arrow_type):
+    """Returns a function converting the values computed by the transform to
+    values of arrow_type, or None where that is not possible.
+    """
+    if pyarrow.types.is_boolean(arrow_type):
+        return lambda v: None if v is None else bool(v)
+    if pyarrow.types.is_integer(arrow_type):
+        return _to_int
+    if pyarrow.types.is_floating(arrow_type):
+        return _to_float
+    if pyarrow.types.is_timestamp(arrow_type):
+        return _to_timestamp
+    return _to_string
+
+
+class ParquetSink(object):
+    """A Parquet dataset of a feature table, partitioned by the year of the
+    balancedato of the financial statements:
+
+        {directory}/{tablename}/year={year}/part-{pid}.parquet
+
+    Rows are buffered per partition and written in row groups of
+    ROW_GROUP_SIZE rows.  Each process writes its own files, so a sink may be
+    used from several processes as long as each calls close.
+
+    columns -- list of (name, sqlalchemy type) of the columns of the rows,
+               which have the Header values of the financial statement as
+               well as the values of the feature table.
+
+    """
+
+    def __init__(self, directory, tablename, columns):
+        if pyarrow is None:
+            raise ImportError('Writing Parquet requires pyarrow, install it '
+                              'with: pip install pyarrow')
+        self.path = os.path.join(directory, tablename)
+        self.schema = pyarrow.schema([(name, arrow_type(alchemy_type))
+                                      for name, alchemy_type in columns])
+        self._converters = [(field.name, converter(field.type))
+                            for field in self.schema]
+        self._buffers = {}
+        self._writers = {}
+
+    def write(self, rows):
+        """Write rows, a list of pairs of Header values and feature table
+        values as returned by make_feature_table.populate_row.
+        """
+        for header, row_values in rows:
+            balancedato = header.get('balancedato')
+            if balancedato is None:
+                partition = DEFAULT_PARTITION
+            else:
+                partition = str(balancedato.year)
+            values = dict(header)
+            values.update(row_values)
+            buffer = self._buffers.setdefault(partition, [])
+            buffer.append(values)
+            if len(buffer) >= ROW_GROUP_SIZE:
+                self._write_row_group(partition)
+        return
+
+    def _write_row_group(self, partition):
+        buffer = self._buffers.pop(partition, None)
+        if not buffer:
+            return
+        arrays = [pyarrow.array([convert(values.get(name))
+                                 for values in buffer], type=field.type)
+                  for (name, convert), field in zip(self._converters,
+                                                    self.schema)]
+        table = pyarrow.Table.from_arrays(arrays, schema=self.schema)
+        writer = self._writers.get(partition)
+        if writer is None:
+            directory = os.path.join(self.path, 'year=%s' % partition)
+            os.makedirs(directory, exist_ok=True)
+            filename = os.path.join(directory,
+                                    'part-%s.parquet' % os.getpid())
+            writer = pyarrow.parquet.ParquetWriter(filename, self.schema)
+            self._writers[partition] = writer
+        writer.write_table(table)
+        return
+
+    def close(self):
+        """Write the buffered rows and close the files."""
+        for partition in list(self._buffers):
+            self._write_row_group(partition)
+        for writer in self._writers.values():
+            writer.close()
+        self._writers = {}
+        return
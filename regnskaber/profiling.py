@@ -0,0 +1,163 @@
+""" Profiling of the commands, enabled with the --profile option.
+
+The command runs under cProfile, and so does each parse and write process of
+the fetch and each transform process, every one writing its own
+{directory}/{name}-{pid}.prof when it is done.  There is one profiler per
+process: a process started while profiling discards the profiler it
+inherited before starting its own, as only one can be active at a time since
+Python 3.12.  The download threads of the fetch are in the profile of the
+fetch process on Python 3.12 and later, and not profiled before that.  The
+methods of the table definitions, see make_feature_table.method_translation,
+are timed as well.
+write_report then summarizes all of it in {directory}/report.txt.
+
+Profiling is a no-op until setup_profiling has been called, and
+setup_profiling must be called before starting the processes to profile.
+"""
+import cProfile
+import glob
+import io
+import json
+import os
+import pstats
+import time
+
+from contextlib import contextmanager
+from functools import wraps
+
+REPORT_LINES = 30  # functions listed per profile in the report.
+
+_directory = None
+
+_method_times = {}  # method name -> [calls, seconds], per process.
+
+_profiler = None  # (pid, cProfile.Profile) of the active profiler.
+
+
+def setup_profiling(directory):
+    """Write profiles to directory from now on, removing earlier ones."""
+    global _directory
+    os.makedirs(directory, exist_ok=True)
+    for path in glob.glob(os.path.join(directory, '*.prof')):
+        os.remove(path)
+    for path in glob.glob(os.path.join(directory, '*.methods.json')):
+        os.remove(path)
+    _directory = directory
+    return
+
+
+def is_enabled():
+    return _directory is not None
+
+
+def _write_method_times(name):
+    if not _method_times:
+        return
+    path = os.path.join(_directory, '%s-%s.methods.json' % (name, os.getpid()))
+    with open(path, 'w') as fp:
+        json.dump(_method_times, fp)
+    _method_times.clear()
+    return
+
+
+@contextmanager
+def profiled(name):
+    """Profile the block, writing the profile as {name}-{pid}.prof.
+
+    If this process is already being profiled the block is part of that
+    profile instead.
+
+    """
+    global _profiler
+    if _directory is None:
+        yield
+        return
+    if _profiler is not None:
+        pid, inherited = _profiler
+        if pid == os.getpid():
+            yield
+            return
+        # the profiler of the parent process, copied when it forked.
+        inherited.disable()
+        _method_times.clear()
+    profiler = cProfile.Profile()
+    profiler.enable()
+    _profiler = (os.getpid(), profiler)
+    try:
+        yield
+    finally:
+        profiler.disable()
+        _profiler = None
+        profiler.dump_stats(os.path.join(_directory,
+                                         '%s-%s.prof' % (name, os.getpid())))
+        _write_method_times(name)
+
+
+def profiled_target(name, target):
+    """Returns target running under profiled(name), to be the target of a
+    Process.
+    """
+    if _directory is None:
+        return target
+
+    @wraps(target)
+    def run(*args, **kwargs):
+        with profiled(name):
+            return target(*args, **kwargs)
+    return run
+
+
+def timed_method(name, method):
+    """Returns method, recording the calls and time spent in it as name if
+    profiling is enabled.
+    """
+    if _directory is None:
+        return method
+
+    @wraps(method)
+    def timed(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            times = _method_times.setdefault(name, [0, 0.0])
+            times[0] += 1
+            times[1] += time.perf_counter() - start
+    return timed
+
+
+def write_report(directory=None):
+    """Write report.txt in directory with the most expensive functions of
+    each profile and the time spent in each method, summed over the
+    processes.  Returns the path of the report.
+    """
+    if directory is None:
+        directory = _directory
+    out = io.StringIO()
+    for path in sorted(glob.glob(os.path.join(directory, '*.prof'))):
+        print('=' * 79, file=out)
+        print(os.path.basename(path), file=out)
+        stats = pstats.Stats(path, stream=out)
+        stats.sort_stats('cumulative').print_stats(REPORT_LINES)
+
+    method_times = {}
+    for path in glob.glob(os.path.join(directory, '*.methods.json')):
+        with open(path) as fp:
+            for name, (calls, seconds) in json.load(fp).items():
+                times = method_times.setdefault(name, [0, 0.0])
+                times[0] += calls
+                times[1] += seconds
+    if method_times:
+        print('=' * 79, file=out)
+        print('%-40s %10s %10s %10s' % ('method', 'calls', 'seconds',
+                                        'mean us'), file=out)
+        for name, (calls, seconds) in sorted(method_times.items(),
+                                             key=lambda item: -item[1][1]):
+            print('%-40s %10d %10.3f %10.1f' % (name, calls, seconds,
+                                                10**6 * seconds / calls),
+                  file=out)
+
+    report_path = os.path.join(directory, 'report.txt')
+    with open(report_path, 'w') as fp:
+        fp.write(out.getvalue())
+    return report_path
@@ -0,0 +1,307 @@
+""" Cached lookups of the financial statements of a company.
+
+The values are selected like the transform selects them: only the entries in
+the reporting period of a financial statement are considered, and of several
+entries of a concept the one chosen by get_most_precise is used.
+
+Results are kept in a least recently used cache of CACHE_SIZE results.  A
+cached result is only used while the company has no newer financial
+statement than when it was computed, so statements inserted by a fetch are
+picked up.  This is checked with a query of the largest financial_statement
+id of the company, so every call costs one query, also when the result is
+cached.  invalidate drops the cached results of a company right away.
+
+The results are shared by the callers through the cache, so they are tuples,
+or copied when returned as in get_latest_statement.
+"""
+import inspect
+import threading
+
+from collections import OrderedDict, namedtuple
+from functools import wraps
+
+from sqlalchemy import and_, func, select
+
+from . import engine
+from .lookups import value_hash
+from .make_feature_table import get_most_precise
+from .models import Concept, FinancialStatement, FinancialStatementEntry
+from .shared import (entry_row_columns, entry_row_from, get_reporting_period,
+                     partition_consolidated, reporting_period_clause,
+                     reporting_period_entries, EntryRow)
+
+CACHE_SIZE = 1024  # cached results.
+
+_MISSING = object()
+
+# the concepts needed to filter the entries not flagged at ingest.
+REPORTING_PERIOD_CONCEPTS = ('gsd:ReportingPeriodStartDate',
+                             'gsd:ReportingPeriodEndDate')
+
+# The value of a concept in a financial statement, see get_series.
+SeriesValue = namedtuple('SeriesValue', [
+    'financial_statement_id', 'offentliggoerelsesTidspunkt',
+    'reportingPeriodStartDate', 'reportingPeriodEndDate', 'value'
+])
+
+# A financial statement with the value of each of its concepts, see
+# get_latest_statement.
+Statement = namedtuple('Statement', [
+    'financial_statement_id', 'erst_id', 'offentliggoerelsesTidspunkt',
+    'reportingPeriodStartDate', 'reportingPeriodEndDate', 'values'
+])
+
+
+class QueryCache(object):
+    """A least recently used cache of the results of the functions of this
+    module, each stored with the largest financial_statement id of the
+    company it was computed for.  Safe to use from several threads.
+    """
+
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self._results = OrderedDict()  # key -> (latest id, result).
+        self._lock = threading.Lock()
+
+    def get(self, key, latest_id):
+        """Returns the result cached for key, or _MISSING if there is none or
+        the company has had financial statements added since.
+        """
+        with self._lock:
+            try:
+                cached_id, result = self._results[key]
+            except KeyError:
+                return _MISSING
+            if cached_id != latest_id:
+                del self._results[key]
+                return _MISSING
+            self._results.move_to_end(key)
+            return result
+
+    def put(self, key, latest_id, result):
+        with self._lock:
+            self._results[key] = (latest_id, result)
+            self._results.move_to_end(key)
+            while len(self._results) > self.size:
+                self._results.popitem(last=False)
+        return
+
+    def invalidate(self, cvrnummer=None):
+        """Drop the results of cvrnummer, or of all companies if None."""
+        with self._lock:
+            if cvrnummer is None:
+                self._results.clear()
+                return
+            cvrnummer = int(cvrnummer)
+            for key in [k for k in self._results if k[1] == cvrnummer]:
+                del self._results[key]
+        return
+
+
+_cache = QueryCache()
+
+
+def invalidate(cvrnummer=None):
+    """Drop the cached results of cvrnummer, or all of them if None."""
+    _cache.invalidate(cvrnummer)
+    return
+
+
+def latest_financial_statement_id(cvrnummer):
+    """Returns the largest financial_statement id of cvrnummer, or None."""
+    fs_table = FinancialStatement.__table__
+    return engine.execute(
+        select([func.max(fs_table.c.id)]).where(
+            fs_table.c.cvrnummer == cvrnummer
+        )
+    ).scalar()
+
+
+def key_value(value):
+    """Returns value as a hashable part of a cache key, e.g. dimensions
+    given as a list.
+    """
+    if isinstance(value, (list, tuple)):
+        return tuple(key_value(v) for v in value)
+    if isinstance(value, (set, frozenset)):
+        return frozenset(key_value(v) for v in value)
+    if isinstance(value, dict):
+        return frozenset((k, key_value(v)) for k, v in value.items())
+    return value
+
+
+def cached(function):
+    """Cache the results of function(cvrnummer, ...) in _cache."""
+    signature = inspect.signature(function)
+
+    @wraps(function)
+    def cached_function(cvrnummer, *args, **kwargs):
+        cvrnummer = int(cvrnummer)
+        arguments = signature.bind(cvrnummer, *args, **kwargs)
+        arguments.apply_defaults()
+        key = (function.__name__,) + tuple(
+            key_value(value) for value in arguments.arguments.values()
+        )
+        latest_id = latest_financial_statement_id(cvrnummer)
+        result = _cache.get(key, latest_id)
+        if result is _MISSING:
+            result = function(*arguments.args, **arguments.kwargs)
+            _cache.put(key, latest_id, result)
+        return result
+    return cached_function
+
+
+def concept_ids(fieldNames):
+    """Returns the ids of the concepts of fieldNames that exist."""
+    concept = Concept.__table__
+    hashes = [value_hash(fieldName) for fieldName in fieldNames]
+    return [row[0] for row in engine.execute(
+        select([concept.c.id]).where(concept.c.hash.in_(hashes))
+    )]
+
+
+def get_statements(cvrnummer):
+    """Returns the financial_statement rows of cvrnummer in order of
+    publication.
+    """
+    fs_table = FinancialStatement.__table__
+    return engine.execute(
+        select([fs_table]).where(
+            fs_table.c.cvrnummer == cvrnummer
+        ).order_by(fs_table.c.offentliggoerelsesTidspunkt, fs_table.c.id)
+    ).fetchall()
+
+
+def get_entries(cvrnummer, financial_statement_ids, fieldNames=None):
+    """Returns a dict from financial_statement id to the EntryRows of the
+    financial statement in its reporting period, for the financial
+    statements of cvrnummer in financial_statement_ids.
+
+    If fieldNames is given only the entries of those concepts are read.
+
+    """
+    entry_table = FinancialStatementEntry.__table__
+    conditions = [
+        entry_table.c.cvrnummer == cvrnummer,
+        entry_table.c.financial_statement_id.in_(financial_statement_ids),
+        reporting_period_clause(),
+    ]
+    if fieldNames is not None:
+        ids = concept_ids(set(fieldNames) | set(REPORTING_PERIOD_CONCEPTS))
+        conditions.append(entry_table.c.conceptId.in_(ids))
+    rows = engine.execute(
+        select(entry_row_columns()).select_from(
+            entry_row_from()
+        ).where(and_(*conditions)).order_by(
+            entry_table.c.financial_statement_id, entry_table.c.id
+        )
+    ).fetchall()
+
+    entries = OrderedDict()
+    for row in map(EntryRow._make, rows):
+        entries.setdefault(row.financial_statement_id, []).append(row)
+    for fs_id, fs_entries in entries.items():
+        try:
+            fs_entries = reporting_period_entries(fs_entries)
+        except (TypeError, ValueError):
+            # not flagged at ingest and without a valid reporting period.
+            fs_entries = []
+        if fieldNames is not None:
+            fs_entries = [e for e in fs_entries if e.fieldName in fieldNames]
+        entries[fs_id] = fs_entries
+    return entries
+
+
+def reporting_period(statement, fs_entries):
+    """Returns the reporting period of a financial_statement row, from its
+    entries if it was not stored at ingest.
+    """
+    if statement.reportingPeriodEndDate is not None:
+        return (statement.reportingPeriodStartDate,
+                statement.reportingPeriodEndDate)
+    try:
+        return get_reporting_period(fs_entries)
+    except (TypeError, ValueError):
+        return None, None
+
+
+def select_value(fs_entries, dimensions=None):
+    """Returns the value of the entries of a concept as the transform
+    selects it, or None if there are none with dimensions.
+    """
+    if dimensions is not None:
+        fs_entries = [t for t in fs_entries if t.dimensions == dimensions]
+    if not fs_entries:
+        return None
+    return get_most_precise(list(fs_entries))
+
+
+@cached
+def get_series(cvrnummer, fieldName, dimensions=None, consolidated=False):
+    """Returns the values of fieldName in the financial statements of
+    cvrnummer as a tuple of SeriesValues, in order of reporting period.
+
+    Of several financial statements of the same reporting period, e.g. a
+    corrected one, the last published is used.  dimensions and consolidated
+    select the entries like the columns of a table definition.
+
+    """
+    statements = get_statements(cvrnummer)
+    if not statements:
+        return ()
+    entries = get_entries(cvrnummer, [s.id for s in statements],
+                          fieldNames=[fieldName] + list(
+                              REPORTING_PERIOD_CONCEPTS
+                          ))
+    series = {}
+    for statement in statements:
+        fs_entries = entries.get(statement.id, [])
+        start_date, end_date = reporting_period(statement, fs_entries)
+        consolidated_entries, solo_entries = partition_consolidated(
+            [e for e in fs_entries if e.fieldName == fieldName]
+        )
+        value = select_value(
+            consolidated_entries if consolidated else solo_entries,
+            dimensions
+        )
+        if value is None:
+            continue
+        # statements are in order of publication, so the last one wins.
+        series[(start_date, end_date)] = SeriesValue(
+            statement.id, statement.offentliggoerelsesTidspunkt, start_date,
+            end_date, value
+        )
+    return tuple(series[period] for period in sorted(
+        series, key=lambda p: (p[1] is None, p[1], p[0] is None, p[0])
+    ))
+
+
+def get_latest_statement(cvrnummer, consolidated=False):
+    """Returns the last published financial statement of cvrnummer as a
+    Statement with the value of each of its concepts, or None if the company
+    has none.
+    """
+    statement = _latest_statement(cvrnummer, consolidated)
+    if statement is None:
+        return None
+    # the values of the cached Statement must not be changed by the caller.
+    return statement._replace(values=OrderedDict(statement.values))
+
+
+@cached
+def _latest_statement(cvrnummer, consolidated=False):
+    statements = get_statements(cvrnummer)
+    if not statements:
+        return None
+    statement = statements[-1]
+    fs_entries = get_entries(cvrnummer, [statement.id]).get(statement.id, [])
+    start_date, end_date = reporting_period(statement, fs_entries)
+    consolidated_entries, solo_entries = partition_consolidated(fs_entries)
+    by_fieldName = OrderedDict()
+    for entry in consolidated_entries if consolidated else solo_entries:
+        by_fieldName.setdefault(entry.fieldName, []).append(entry)
+    values = OrderedDict((fieldName, select_value(entries))
+                         for fieldName, entries in by_fieldName.items())
+    return Statement(statement.id, statement.erst_id,
+                     statement.offentliggoerelsesTidspunkt, start_date,
+                     end_date, values)
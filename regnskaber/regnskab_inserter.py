@@ -4,12 +4,23 @@ import datetime
 import xbrl_ai
 import xbrl_local.xbrl_ai_dk
 
-from . import Session
+from . import engine
+from .lookups import resolve_entry_lookups
 from .models import FinancialStatement, FinancialStatementEntry
+from .shared import (parse_decimals, parse_numeric_value,
+                     reporting_period_flags)
+
+# The order of the values in the entry tuples returned by parse_regnskab.
+ENTRY_COLUMNS = ('fieldName', 'fieldValue', 'decimals', 'cvrnummer',
+                 'startDate', 'endDate', 'dimensions', 'unitIdXbrl', 'koncern',
+                 'numericValue', 'decimalsValue', 'inReportingPeriod')
+
+INSERT_CHUNK_SIZE = 5000  # entries per executemany.
 
 
 def initialize_financial_statement(regnskab):
-    financial_statement = FinancialStatement(
+    """Returns the values of the financial_statement row for regnskab."""
+    financial_statement = dict(
         offentliggoerelsesTidspunkt=regnskab.offentliggoerelsesTidspunkt,
         indlaesningsTidspunkt=regnskab.indlaesningsTidspunkt,
         cvrnummer=regnskab.cvrnummer,
@@ -18,54 +29,89 @@ def initialize_financial_statement(regnskab):
     return financial_statement
 
 
+def parse_regnskab(regnskab):
+    """Parse the xbrl file of regnskab.
+
+    Returns a pair of the values of the financial_statement row and a list of
+    tuples with the values of its entries, ordered as ENTRY_COLUMNS.
+
+    """
+    x = xbrl_ai.xbrlinstance_to_dict(regnskab.xbrl_file_contents)
+    y = xbrl_local.xbrl_ai_dk.xbrldict_to_xbrl_dk_64(x)
+    financial_statement = initialize_financial_statement(regnskab)
+    entries = []
+    for key, val in y.items():
+        if key in ('{http://www.xbrl.org/2003/linkbase}schemaRef',
+                   '@{http://www.w3.org/2001/XMLSchema-instance}'
+                   'schemaLocation'):
+            continue
+        fieldName, startDate, endDate = key[0], key[1], key[2]
+        label_typed_id, koncern, xbrl_unit = key[3], key[4], key[5]
+        fieldValue, unit, decimals, dimension_list = val
+
+        if xbrl_unit is not None:
+            xbrl_unit = str(xbrl_unit)
+        if unit is not None:
+            unit = str(unit)
+        if fieldValue is not None:
+            fieldValue = str(fieldValue)
+        if decimals is not None:
+            decimals = str(decimals)
+        assert xbrl_unit == unit
+
+        dimensions = label_typed_id
+        # keys in row:
+        # Name,Value,contextRef,unitRef,Dec,Prec,Lang,EntityIdentifier,Start,End/Instant,Dimensions
+        cvrnummer = regnskab.cvrnummer
+
+        entries.append((fieldName, fieldValue, decimals, cvrnummer,
+                        startDate, endDate, dimensions, xbrl_unit, koncern,
+                        parse_numeric_value(fieldValue, decimals),
+                        parse_decimals(decimals)))
+
+    (start_date, end_date), flags = reporting_period_flags(
+        [(e[0], e[1], e[4], e[5]) for e in entries]
+    )
+    financial_statement['reportingPeriodStartDate'] = start_date
+    financial_statement['reportingPeriodEndDate'] = end_date
+    entries = [entry + (flag,) for entry, flag in zip(entries, flags)]
+    return financial_statement, entries
+
+
+def insert_parsed(parsed_statements):
+    """Insert financial statements returned by parse_regnskab.
+
+    All the financial statements are inserted in a single transaction and the
+    entries are written with executemany.  The concepts, dimensions and units
+    of the entries are created in the lookup tables first.
+
+    """
+    financial_statement_table = FinancialStatement.__table__
+    entry_table = FinancialStatementEntry.__table__
+    entry_rows = []
+    for _, entries in parsed_statements:
+        rows = [dict(zip(ENTRY_COLUMNS, entry)) for entry in entries]
+        entry_rows.append(resolve_entry_lookups(rows))
+    with engine.begin() as connection:
+        rows = []
+        for (financial_statement, _), statement_rows in zip(parsed_statements,
+                                                            entry_rows):
+            result = connection.execute(financial_statement_table.insert(),
+                                        financial_statement)
+            financial_statement_id = result.inserted_primary_key[0]
+            for row in statement_rows:
+                row['financial_statement_id'] = financial_statement_id
+                rows.append(row)
+            if len(rows) >= INSERT_CHUNK_SIZE:
+                connection.execute(entry_table.insert(), rows)
+                rows = []
+        if rows:
+            connection.execute(entry_table.insert(), rows)
+    return
+
+
 def insert_regnskab(regnskab):
-    session = Session()
-    try:
-        x = xbrl_ai.xbrlinstance_to_dict(regnskab.xbrl_file_contents)
-        y = xbrl_local.xbrl_ai_dk.xbrldict_to_xbrl_dk_64(x)
-        financial_statement = initialize_financial_statement(regnskab)
-        session.add(financial_statement)
-        for key, val in y.items():
-            if key in ('{http://www.xbrl.org/2003/linkbase}schemaRef',
-                       '@{http://www.w3.org/2001/XMLSchema-instance}schemaLocation'):
-                continue
-            fieldName, startDate, endDate = key[0], key[1], key[2]
-            label_typed_id, koncern, xbrl_unit = key[3], key[4], key[5]
-            fieldValue, unit, decimals, dimension_list = val
-
-            if xbrl_unit is not None:
-                xbrl_unit = str(xbrl_unit)
-            if unit is not None:
-                unit = str(unit)
-            if fieldValue is not None:
-                fieldValue = str(fieldValue)
-            if decimals is not None:
-                decimals = str(decimals)
-            assert(xbrl_unit == unit)
-
-            dimensions = label_typed_id
-            # keys in row:
-            # Name,Value,contextRef,unitRef,Dec,Prec,Lang,EntityIdentifier,Start,End/Instant,Dimensions
-            cvrnummer = regnskab.cvrnummer
-
-            financial_statement.financial_statement_entries.append(
-                FinancialStatementEntry(
-                    fieldName=fieldName, fieldValue=fieldValue,
-                    decimals=decimals,
-                    cvrnummer=cvrnummer,
-                    startDate=startDate, endDate=endDate,
-                    dimensions=dimensions,
-                    unitIdXbrl=xbrl_unit,
-                    koncern=koncern
-                )
-            )
-
-        session.commit()
-    except Exception:
-        session.rollback()
-        raise
-    finally:
-        session.close()
+    insert_parsed([parse_regnskab(regnskab)])
     return
 
 
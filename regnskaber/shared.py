@@ -1,12 +1,39 @@
 import datetime
 
+from collections import namedtuple
 from contextlib import closing
+from itertools import groupby
+from operator import attrgetter
 
-from .models import FinancialStatement
-from . import Session
+from .models import (DECIMALS_INF, Concept, DimensionSet, FinancialStatement,
+                     FinancialStatementEntry, Unit)
+from . import Session, engine
 
+from sqlalchemy import and_, or_, select
 from sqlalchemy.sql.expression import func
 
+# The columns of financial_statement_entry read by transform.
+EntryRow = namedtuple('EntryRow', [
+    'id', 'financial_statement_id', 'fieldName', 'fieldValue', 'decimals',
+    'cvrnummer', 'startDate', 'endDate', 'dimensions', 'unitIdXbrl', 'koncern',
+    'numericValue', 'decimalsValue', 'inReportingPeriod'
+])
+
+# financial statement ids per query when iterating over a set of ids.
+STATEMENT_WINDOW_SIZE = 500
+
+# estimated bytes of memory per entry read besides its fieldValue, including
+# what transform derives from it, see EntryBatchSize.
+ENTRY_ROW_BYTES = 1000
+
+# bytes of memory counted per character of fieldValue read, with a margin for
+# the copies held by the database driver while a batch is read.
+FIELD_VALUE_BYTES = 2
+
+# entries in the first batch read within a memory limit, before the size of
+# the entries is known.
+FIRST_BATCH_SIZE = 100
+
 
 def get_reporting_period(fs_entries):
     date_format = '%Y-%m-%d'
@@ -39,28 +66,88 @@ def date_is_instant(start_date, end_date):
     return start_date is None and end_date is not None
 
 
+def entry_in_reporting_period(start_date, end_date, entry_start_date,
+                              entry_end_date):
+    """Returns whether an entry with the given period is in the reporting
+    period [start_date, end_date].
+    """
+    if entry_start_date is None and entry_end_date is None:
+        return False
+    if date_is_instant(entry_start_date, entry_end_date):
+        return date_is_in_range(start_date, end_date, entry_end_date)
+    return (date_is_in_range(start_date, end_date, entry_start_date) and
+            date_is_in_range(start_date, end_date, entry_end_date))
+
+
 def filter_reporting_period(fs_entries):
     """
     returns a subset fs_entries where each entry is in the reporting period.
 
     """
     start_date, end_date = get_reporting_period(fs_entries)
-    result = []
-    for entry in fs_entries:
-        if entry.startDate is None and entry.endDate is None:
-            continue
-        if date_is_instant(entry.startDate, entry.endDate):
-            if date_is_in_range(start_date, end_date, entry.endDate):
-                # append to result
-                result.append(entry)
-            continue
+    return [entry for entry in fs_entries
+            if entry_in_reporting_period(start_date, end_date,
+                                         entry.startDate, entry.endDate)]
 
-        if (not date_is_in_range(start_date, end_date, entry.startDate) or
-                not date_is_in_range(start_date, end_date, entry.endDate)):
-            continue
-        result.append(entry)
 
-    return result
+def reporting_period_clause():
+    """Returns the condition on financial_statement_entry excluding the
+    entries flagged out of the reporting period, see reporting_period_entries.
+    """
+    in_reporting_period = FinancialStatementEntry.__table__.c.inReportingPeriod
+    return or_(in_reporting_period == True,  # noqa: E712
+               in_reporting_period.is_(None))
+
+
+def reporting_period_entries(fs_entries):
+    """Returns the entries of a financial statement in its reporting period,
+    given fs_entries read with reporting_period_clause.
+    """
+    if any(entry.inReportingPeriod is None for entry in fs_entries):
+        # not flagged at ingest, e.g. not yet backfilled by migrate.
+        return filter_reporting_period(fs_entries)
+    return fs_entries
+
+
+def as_datetime(value):
+    """Returns a date given as a datetime, date or string as a datetime."""
+    if value is None or isinstance(value, datetime.datetime):
+        return value
+    if isinstance(value, datetime.date):
+        return datetime.datetime(value.year, value.month, value.day)
+    return datetime.datetime.strptime(str(value)[:10], '%Y-%m-%d')
+
+
+def reporting_period_flags(entries):
+    """Returns the reporting period of a financial statement and whether
+    each of its entries is in it, for entries given as (fieldName,
+    fieldValue, startDate, endDate) tuples.
+
+    The reporting period is (None, None) and the flags are None if the
+    financial statement has no valid gsd:ReportingPeriodStartDate and
+    gsd:ReportingPeriodEndDate.
+
+    """
+    values = {}
+    for fieldName, fieldValue, _, _ in entries:
+        if fieldName in ('gsd:ReportingPeriodStartDate',
+                         'gsd:ReportingPeriodEndDate'):
+            values[fieldName] = fieldValue
+    try:
+        start_date = as_datetime(values['gsd:ReportingPeriodStartDate'])
+        end_date = as_datetime(values['gsd:ReportingPeriodEndDate'])
+    except (KeyError, TypeError, ValueError):
+        return (None, None), [None] * len(entries)
+    flags = []
+    for _, _, entry_start_date, entry_end_date in entries:
+        try:
+            flags.append(entry_in_reporting_period(
+                start_date, end_date, as_datetime(entry_start_date),
+                as_datetime(entry_end_date)
+            ))
+        except (TypeError, ValueError):
+            flags.append(None)
+    return (start_date, end_date), flags
 
 
 def arelle_parse_value(d):
@@ -78,6 +165,33 @@ def arelle_parse_value(d):
     return d
 
 
+def parse_decimals(decimals):
+    """Returns decimals as an int, DECIMALS_INF for INF, or None."""
+    if decimals is None:
+        return None
+    if decimals.strip().lower() == 'inf':
+        return DECIMALS_INF
+    try:
+        return int(decimals)
+    except ValueError:
+        return None
+
+
+def parse_numeric_value(fieldValue, decimals):
+    """Returns the value of a numeric fact as a float, or None if the fact is
+    not numeric.  Only numeric facts have decimals.
+    """
+    if fieldValue is None or decimals is None:
+        return None
+    try:
+        value = float(fieldValue.replace(',', ''))
+    except ValueError:
+        return None
+    if value != value or value in (float('inf'), float('-inf')):
+        return None
+    return value
+
+
 def partition_consolidated(fs_entries):
     fs_tuples_cons = [r for r in fs_entries
                       if r.koncern]
@@ -93,50 +207,220 @@ def get_number_of_rows():
         return total_rows
 
 
-def financial_statement_iterator(end_idx=None, length=None, buffer_size=500):
+class EntryBatchSize(object):
+    """The number of entries to read per batch.
+
+    Without a memory_limit this is a fixed size.  Within memory_limit bytes
+    the first batch is FIRST_BATCH_SIZE entries, and every batch read is
+    passed to update, which sizes the next one from the bytes of the
+    fieldValues of the batch, see ENTRY_ROW_BYTES and FIELD_VALUE_BYTES.
+    The size shrinks at once when the entries get larger, e.g. at text
+    blocks of notes, and at most doubles per batch when they get smaller.
+
+    """
+
+    def __init__(self, size=10000, memory_limit=None):
+        self.memory_limit = memory_limit
+        if memory_limit is None:
+            self.size = size
+        else:
+            self.size = max(1, min(FIRST_BATCH_SIZE,
+                                   memory_limit // ENTRY_ROW_BYTES))
+
+    def update(self, rows):
+        if self.memory_limit is None or not rows:
+            return
+        batch_bytes = sum(
+            ENTRY_ROW_BYTES + FIELD_VALUE_BYTES * len(row.fieldValue or '')
+            for row in rows
+        )
+        fitting = self.memory_limit * len(rows) // batch_bytes
+        self.size = max(1, min(2 * self.size, fitting))
+        return
+
+
+def _streamed_rows(query, batch_size):
+    """Iterate over the rows of query as EntryRows using a server-side
+    cursor, fetching batch_size.size rows at a time.
+    """
+    with engine.connect() as connection:
+        result = connection.execution_options(stream_results=True).execute(
+            query
+        )
+        while True:
+            rows = None  # release the batch before reading the next one.
+            rows = [EntryRow._make(row)
+                    for row in result.fetchmany(batch_size.size)]
+            if not rows:
+                return
+            batch_size.update(rows)
+            yield from rows
+
+
+def _keyset_rows(query, batch_size):
+    """Iterate over the rows of query as EntryRows, reading batch_size.size
+    entries per query.  query must be ordered by financial_statement_id and
+    id, and each batch continues after the last entry of the previous one.
+    """
+    entry_table = FinancialStatementEntry.__table__
+    financial_statement_id = entry_table.c.financial_statement_id
+    entry_id = entry_table.c.id
+    batch_query = query
+    while True:
+        limit = batch_size.size
+        rows = [EntryRow._make(row)
+                for row in engine.execute(batch_query.limit(limit))]
+        batch_size.update(rows)
+        yield from rows
+        if len(rows) < limit:
+            return
+        last = rows[-1]
+        rows = None  # release the batch before reading the next one.
+        batch_query = query.where(and_(
+            financial_statement_id >= last.financial_statement_id,
+            or_(financial_statement_id > last.financial_statement_id,
+                entry_id > last.id)
+        ))
+
+
+def _rows_of_ids(query, ids, window_size, batch_size):
+    """Iterate over the rows of query as EntryRows of the financial
+    statements in the sorted list ids, window_size financial statements and
+    at most batch_size.size entries per query.
+    """
+    financial_statement_id = FinancialStatementEntry.__table__.c[
+        'financial_statement_id'
+    ]
+    for i in range(0, len(ids), window_size):
+        yield from _keyset_rows(query.where(
+            financial_statement_id.in_(ids[i:i + window_size])
+        ), batch_size)
+
+
+def entry_row_columns():
+    """Returns the columns of an EntryRow, the fieldName, dimensions and
+    unitIdXbrl being read from the lookup tables, see entry_row_from.
+    """
+    entry_table = FinancialStatementEntry.__table__
+    lookup_columns = {
+        'fieldName': Concept.__table__.c.value,
+        'dimensions': DimensionSet.__table__.c.value,
+        'unitIdXbrl': Unit.__table__.c.value,
+    }
+    columns = []
+    for name in EntryRow._fields:
+        if name in lookup_columns:
+            columns.append(lookup_columns[name].label(name))
+        else:
+            columns.append(entry_table.c[name])
+    return columns
+
+
+def entry_row_from():
+    """Returns financial_statement_entry joined with its lookup tables."""
+    entry_table = FinancialStatementEntry.__table__
+    concept = Concept.__table__
+    dimension_set = DimensionSet.__table__
+    unit = Unit.__table__
+    return entry_table.outerjoin(
+        concept, entry_table.c.conceptId == concept.c.id
+    ).outerjoin(
+        dimension_set, entry_table.c.dimensionSetId == dimension_set.c.id
+    ).outerjoin(
+        unit, entry_table.c.unitId == unit.c.id
+    )
+
+
+def get_end_idx():
+    """Returns one past the largest financial_statement_id."""
+    try:
+        session = Session()
+        max_id = session.query(func.max(FinancialStatement.id)).scalar()
+        return max_id + 1
+    except (IndexError, ValueError, TypeError):
+        raise LookupError('Could not lookup maximum financial_statement_id'
+                          ' in financial_statement table.')
+    finally:
+        session.close()
+
+
+def financial_statement_iterator(end_idx=None, length=None,
+                                 buffer_size=10000, start_idx=1, ids=None,
+                                 memory_limit=None):
     """Provide an iterator over financial_statements in order of id
 
+    Yields tuples (i, total_rows, financial_statement_id, entries) where
+    entries are the EntryRows of the financial statement in its reporting
+    period.  Entries flagged out of the reporting period at ingest are
+    filtered in the query, and financial statements whose entries are not
+    flagged are filtered with filter_reporting_period.
+
+    The entries of all financial statements are streamed in a single query
+    ordered by financial_statement_id, using a server-side cursor where the
+    database supports it.  Otherwise the entries are read in batches per
+    query, however many financial statements they belong to.  Either way
+    memory does not depend on the number or size of the financial
+    statements, beyond holding the entries of the current one.  Financial
+    statements without entries are skipped.
+
     Keyword arguments:
     end_idx -- One past the last financial_statement_id to iterate over.
-    length -- The number of financial statements to iterate.
+    length -- The number of financial_statement_ids from start_idx to
+              iterate over.
               Note only one of end_idx and length can be provided.
-    buffer_size -- the internal buffer size to use for iterating.  The buffer
-                   size is measured in number of financial statements.
+    buffer_size -- the number of entries fetched from the database at a
+                   time.
+    start_idx -- The first financial_statement_id to iterate over.
+    ids -- If given, only the financial statements with these ids are
+           iterated over, STATEMENT_WINDOW_SIZE at a time.
+    memory_limit -- If given, the bytes of memory to use for the entries
+                    read, replacing buffer_size, see EntryBatchSize.
 
     """
+    batch_size = EntryBatchSize(buffer_size, memory_limit)
 
     if end_idx is not None and length is not None:
         raise ValueError("Cannot accept both end_idx and length.")
 
     if end_idx is None and length is None:
-        try:
-            session = Session()
-            max_id = session.query(func.max(FinancialStatement.id)).scalar()
-            end_idx = max_id + 1
-        except (IndexError, ValueError):
-            raise LookupError('Could not lookup maximum financial_statement_id'
-                              ' in financial_statement table.')
-        finally:
-            session.close()
+        if ids is not None:
+            end_idx = max(ids, default=start_idx - 1) + 1
+        else:
+            end_idx = get_end_idx()
 
     if end_idx is not None:
         assert(isinstance(end_idx, int))
 
     if length is not None:
         assert(isinstance(length, int))
-        end_idx = length
-
-    total_rows = get_number_of_rows()
-
-    with closing(Session()) as session:
-        curr = 1
-        while curr < end_idx:
-            q = session.query(FinancialStatement).filter(
-                FinancialStatement.id >= curr,
-                FinancialStatement.id < min(curr + buffer_size, end_idx)
-            ).enable_eagerloads(True).all()
-            for i, fs in enumerate(q):
-                entries = filter_reporting_period(fs.financial_statement_entries)
-                yield i+curr, total_rows, fs.id, entries
-            curr += buffer_size
+        end_idx = start_idx + length
+
+    if ids is not None:
+        ids = sorted(i for i in ids if start_idx <= i < end_idx)
+        total_rows = len(ids)
+    else:
+        total_rows = get_number_of_rows()
+
+    entry_table = FinancialStatementEntry.__table__
+    query = select(
+        entry_row_columns()
+    ).select_from(
+        entry_row_from()
+    ).where(and_(
+        entry_table.c.financial_statement_id >= start_idx,
+        entry_table.c.financial_statement_id < end_idx,
+        reporting_period_clause()
+    )).order_by(
+        entry_table.c.financial_statement_id, entry_table.c.id
+    )
+    if ids is not None:
+        rows = _rows_of_ids(query, ids, STATEMENT_WINDOW_SIZE, batch_size)
+    elif engine.dialect.supports_server_side_cursors:
+        rows = _streamed_rows(query, batch_size)
+    else:
+        # e.g. SQLite, where an open cursor blocks the writes of the caller.
+        rows = _keyset_rows(query, batch_size)
+    statements = groupby(rows, attrgetter('financial_statement_id'))
+    for i, (fs_id, entries) in enumerate(statements, 1):
+        yield i, total_rows, fs_id, reporting_period_entries(list(entries))
     return
@@ -1,25 +1,124 @@
-import requests
+import json
+import os
+import sys
+import tempfile
+import time
 import xml.etree.ElementTree as ET
-from io import StringIO
-
 
-def build_unit_map():
-
-    # Download and parse the following xml file.
-    # It contains many units.
-    utr_url = 'https://www.xbrl.org/utr/utr.xml'
+from io import StringIO
+from pathlib import Path
 
-    r = requests.get(utr_url)
+import requests
 
-    if r.status_code == 200:
-        pass
+UTR_URL = 'https://www.xbrl.org/utr/utr.xml'
+
+# The unit type registry is cached in the cache directory of the user, with a
+# sidecar file holding the ETag and Last-Modified of the cached copy.
+UTR_CACHE_PATH = Path(
+    os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache'
+) / 'regnskaber' / 'utr.xml'
+
+UTR_MAX_AGE = 7 * 24 * 60 * 60  # seconds before checking for a new version.
+
+UTR_TIMEOUT = 60
+
+
+def _read_utr_cache(path):
+    """Returns the cached registry and its sidecar metadata, or (None, {})."""
+    try:
+        with open(str(path), encoding='utf-8') as fp:
+            text = fp.read()
+    except FileNotFoundError:
+        return None, {}
+    try:
+        with open(str(path) + '.json') as fp:
+            meta = json.load(fp)
+    except (FileNotFoundError, ValueError):
+        meta = {}
+    return text, meta
+
+
+def _write_atomically(path, text):
+    directory = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as fp:
+            fp.write(text)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    return
+
+
+def _write_utr_cache(path, text, meta):
+    try:
+        os.makedirs(os.path.dirname(str(path)), exist_ok=True)
+        if text is not None:
+            _write_atomically(str(path), text)
+        _write_atomically(str(path) + '.json', json.dumps(meta))
+    except OSError as e:
+        print('Could not cache the unit type registry in %s: %s' % (path, e),
+              file=sys.stderr)
+    return
+
+
+def load_utr(cache_path=UTR_CACHE_PATH, max_age=UTR_MAX_AGE):
+    """Returns the unit type registry xml file.
+
+    The registry is cached in cache_path.  A cached copy older than max_age
+    seconds is revalidated with a conditional request using its ETag and
+    Last-Modified, so an unchanged registry is not downloaded again.  If the
+    registry cannot be fetched, a stale cached copy is used instead.
 
-    tree = ET.parse(StringIO(r.text))
-    utr = tree.getroot()
-    units = utr.getchildren()[0]
+    """
+    text, meta = _read_utr_cache(cache_path)
+    if text is not None and time.time() - meta.get('fetched', 0) < max_age:
+        return text
+
+    headers = {}
+    if text is not None:
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+    try:
+        r = requests.get(UTR_URL, headers=headers, timeout=UTR_TIMEOUT)
+        if r.status_code not in (200, 304):
+            r.raise_for_status()
+            raise requests.RequestException('Unexpected status code %s' %
+                                            r.status_code)
+    except requests.RequestException as e:
+        if text is None:
+            raise
+        print('Could not fetch the unit type registry, using the cached '
+              'copy from %s: %s' % (cache_path, e), file=sys.stderr)
+        return text
+
+    meta['fetched'] = time.time()
+    if r.status_code == 304:
+        _write_utr_cache(cache_path, None, meta)
+        return text
+
+    r.encoding = 'utf-8'
+    meta['etag'] = r.headers.get('ETag')
+    meta['last_modified'] = r.headers.get('Last-Modified')
+    _write_utr_cache(cache_path, r.text, meta)
+    return r.text
+
+
+def build_unit_map(utr=None):
+    """Returns a dict from unitId to unitName of the units in the unit type
+    registry utr, see load_utr.
+    """
+    if utr is None:
+        utr = load_utr()
 
     ns = '{http://www.xbrl.org/2009/utr}'
 
+    root = ET.parse(StringIO(utr)).getroot()
+    units = root.find('./%sunits' % ns)
+
     unit_map = {
         unit_id.text: unit_name.text
         for unit_id, unit_name in (
@@ -31,15 +130,61 @@ def build_unit_map():
     return unit_map
 
 
-def translate_units(document, unit_map):
+class UnitIndex(object):
+    """Finds the unitId in unit_map matching a measure such as iso4217:DKK.
+
+    The match is the longest unitId occurring in the measure, as long as its
+    length is within 2 of the measure without its prefix.  Candidates are
+    found by looking up the substrings of the measure, longest first, in the
+    order of unit_map, and the unitId found for each measure is memoized.
+
+    """
+
+    def __init__(self, unit_map):
+        self.unit_map = unit_map
+        self._order = {unit_id: i for i, unit_id in enumerate(unit_map)}
+        self._lengths = sorted({len(unit_id) for unit_id in unit_map},
+                               reverse=True)
+        self._memo = {}
+
+    def _longest_unit_id(self, measure):
+        for length in self._lengths:
+            if length > len(measure):
+                continue
+            found = [measure[i:i + length]
+                     for i in range(len(measure) - length + 1)
+                     if measure[i:i + length] in self._order]
+            if found:
+                return min(found, key=self._order.__getitem__)
+        return None
+
+    def lookup(self, measure):
+        """Returns (unitId, unitName) for measure, or None."""
+        try:
+            unit_id = self._memo[measure]
+        except KeyError:
+            unit_id = self._memo[measure] = self._longest_unit_id(measure)
+        if unit_id is None:
+            return None
+        measure_no_prefix = measure.split(':', maxsplit=1)[-1]
+        if abs(len(measure_no_prefix) - len(unit_id)) > 2:
+            print('found unit was no good')
+            return None
+        return (unit_id, self.unit_map[unit_id])
+
+
+def translate_units(document, unit_index):
     """
     document is an xml document that defines units.
-    The unit_map argument is produced by build_unit_map().
+    The unit_index argument is a UnitIndex, or a unit_map produced by
+    build_unit_map().
 
     The return value is a dict with unitId to unitName where unitId comes from
     the definition in document and unitName comes from the definition in
     unit_map.
     """
+    if not isinstance(unit_index, UnitIndex):
+        unit_index = UnitIndex(unit_index)
     tree = ET.parse(StringIO(document))
     root = tree.getroot()
     ns = '{http://www.xbrl.org/2003/instance}'
@@ -47,33 +192,24 @@ def translate_units(document, unit_map):
     result = dict()
     for unit in units:
         unit_id = unit.attrib['id']
-        children = unit.getchildren()
+        children = list(unit)
         if len(children) != 1 or not children[0].tag.endswith('measure'):
             # error
             print('Something bad happened with unit_id %s' % unit.attrib['id'])
             continue
 
-        measure = children[0].text
-        measure_no_prefix = measure.split(':', maxsplit=1)[-1]
-
-        search = [(k, len(k)) for k in unit_map.keys() if k in measure]
-        if not len(search):
-            continue
-        ans = max(search, key=lambda x: x[1])
-
-        best_length = ans[1]
-        if abs(len(measure_no_prefix) - best_length) > 2:
-            print('found unit was no good')
-        else:
-            result[unit_id] = (ans[0], unit_map[ans[0]])
+        found = unit_index.lookup(children[0].text)
+        if found is not None:
+            result[unit_id] = found
 
     return result
 
 
 class UnitHandler(object):
 
-    def __init__(self):
-        self.unit_map = build_unit_map()
+    def __init__(self, cache_path=UTR_CACHE_PATH, max_age=UTR_MAX_AGE):
+        self.unit_map = build_unit_map(load_utr(cache_path, max_age))
+        self.unit_index = UnitIndex(self.unit_map)
 
     def translate_units(self, document):
-        return translate_units(document, self.unit_map)
+        return translate_units(document, self.unit_index)
@@ -34,6 +34,9 @@ setup(
         'xmljson==0.1.9',
         'xbrl_ai>=0.2',
     ],
+    extras_require={
+        'parquet': ['pyarrow'],
+    },
     dependency_links=[
         'git+https://github.com/Niels-Peter/XBRL-AI.git@8a90c18ed495487797c6f82d0e6bc8618b5c0bce#egg=xbrl_ai-0.2',
     ],